@@ -1,6 +1,11 @@
 import asyncio
+import os
+from collections import deque
+
 import serial
 
+from FrameTracker import FrameTracker
+
 
 class Timeout(serial.Timeout):
     def __init__(self, duration, expired_action=None, *args, **kwargs):
@@ -37,91 +42,214 @@ class Timeout(serial.Timeout):
 
 
 class AsyncSerial(serial.Serial):
+    POLL_INTERVAL = 0.005
 
     def __init__(self, *args, **kwargs):
         # COM read or write operations should not block
         kwargs['timeout'] = 0.0
         kwargs['write_timeout'] = 0.0
+        # received bytes and coroutines awaiting them
+        self.buffer = bytearray()
+        self.waiters = deque()
+        # requests waiting for responses and counters of late and stale frames
+        self.tracker = FrameTracker()
+        self.loop = None
+        self.poll_task = None
         super().__init__(*args, **kwargs)
+        # serializes transactions of port users, port methods do not acquire it
         self.async_lock = asyncio.Lock()
 
+    @property
+    def ready(self):
+        return self.isOpen()
+
+    @property
+    def stats(self):
+        return self.tracker.stats
+
+    def start_reading(self):
+        # register port in running event loop, input is delivered by _read_ready() callback
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.stop_reading()
+        self.loop = loop
+        try:
+            loop.add_reader(self.fileno(), self._read_ready)
+        except (AttributeError, NotImplementedError, ValueError):
+            # port handle is not selectable (Windows), poll it from a task
+            self.poll_task = loop.create_task(self._poll())
+
+    def stop_reading(self):
+        if self.loop is None:
+            return
+        if self.poll_task is not None:
+            self.poll_task.cancel()
+            self.poll_task = None
+        elif not self.loop.is_closed():
+            try:
+                self.loop.remove_reader(self.fileno())
+            except:
+                pass
+        self.loop = None
+
+    async def _poll(self):
+        while True:
+            if self.in_waiting > 0:
+                self._read_ready()
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    def _read_ready(self):
+        try:
+            data = super().read(max(self.in_waiting, 1))
+        except Exception as ex:
+            while self.waiters:
+                waiter = self.waiters.popleft()[2]
+                if not waiter.done():
+                    waiter.set_exception(ex)
+            return
+        if data:
+            self.buffer += data
+            self._deliver()
+
+    def _take(self, terminator, size):
+        # remove and return first complete frame from buffer or None
+        n = -1
+        if terminator is not None:
+            n = self.buffer.find(terminator)
+            if n >= 0:
+                n += len(terminator)
+        if size is not None and len(self.buffer) >= size and (n < 0 or n > size):
+            n = size
+        if n < 0:
+            return None
+        result = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return result
+
+    def _deliver(self):
+        while self.waiters:
+            terminator, size, waiter = self.waiters[0]
+            if waiter.done():
+                # cancelled or timed out
+                self.waiters.popleft()
+                continue
+            frame = self._take(terminator, size)
+            if frame is None:
+                return
+            self.waiters.popleft()
+            self.tracker.answered()
+            waiter.set_result(frame)
+
+    async def _wait_frame(self, terminator, size, timeout):
+        self.start_reading()
+        if not self.waiters:
+            frame = self._take(terminator, size)
+            if frame is not None:
+                self.tracker.answered()
+                return frame
+        waiter = self.loop.create_future()
+        self.waiters.append((terminator, size, waiter))
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self.tracker.timed_out()
+            raise serial.SerialTimeoutException('Read timeout')
+
     async def read(self, size=1, timeout=None):
         # Non locking access to COM port operation. Use read_until() to prevent concurrent reading form the port.
-        result = bytes()
         if size < 0:
-            size = self.in_waiting
+            size = len(self.buffer) + self.in_waiting
         if size == 0:
             await asyncio.sleep(0)
-            return result
-        to = Timeout(timeout, serial.SerialTimeoutException('Read timeout'))
-        while len(result) < size:
-            d = super().read(1)
-            if d:
-                result += d
-                to.restart()
-            to.check()
-            await asyncio.sleep(0)
-        return result
+            return bytes()
+        return await self._wait_frame(None, size, timeout)
 
     async def read_until(self, terminator=b'\r', size=None, timeout=None):
         """
         Read until a termination sequence is found ('\r' by default),
-        the size is exceeded or timeout occurs.
+        the size is exceeded or timeout occurs. Concurrent readers get frames in order of their calls.
         """
-        result = bytearray()
-        to = Timeout(timeout, serial.SerialTimeoutException('Read timeout'))
-        async with self.async_lock:
-            while True:
-                c = super().read(1)
-                if c:
-                    result += c
-                    if terminator in result:
-                        break
-                    if size is not None and len(result) >= size:
-                        break
-                    to.restart()
-                to.check()
-                await asyncio.sleep(0)
-        return bytes(result)
+        return await self._wait_frame(terminator, size, timeout)
+
+    def close(self):
+        self.stop_reading()
+        super().close()
 
     async def write(self, data, timeout=None):
+        """
+        Write whole data by one call. Wait for port writability only if OS buffer is full.
+        Returns number of bytes written, it is less than len(data) if timeout expires.
+        """
+        # frames which were not read by their requests are discarded instead of port flushing
+        self.tracker.expire()
+        if not self.waiters:
+            self.tracker.discard(self.buffer)
+        self.tracker.written(data, getattr(self, '_current_addr', -1))
+        view = memoryview(data)
         to = Timeout(timeout)
-        result = 0
-        async with self.async_lock:
-            for d in data:
-                n = super().write(d.to_bytes(1, 'big'))
-                if n <= 0:
-                    raise serial.SerialTimeoutException('Write error')
-                result += n
-                if to.expired():
-                    raise serial.SerialTimeoutException('Write timeout')
-                await asyncio.sleep(0)
+        result = self._write_some(view)
+        while result < len(view):
+            if to.expired() or not await self._wait_writable(to.time_left()):
+                break
+            result += self._write_some(view[result:])
         return result
 
+    def _write_some(self, data):
+        # write as much as OS buffer accepts without blocking
+        try:
+            fd = self.fileno()
+        except AttributeError:
+            # Windows port with zero write timeout
+            return super().write(data)
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        try:
+            return os.write(fd, data)
+        except BlockingIOError:
+            return 0
+
+    async def _wait_writable(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        try:
+            fd = self.fileno()
+            loop.add_writer(fd, lambda: waiter.done() or waiter.set_result(True))
+        except (AttributeError, NotImplementedError, ValueError):
+            # port handle is not selectable (Windows)
+            await asyncio.sleep(self.POLL_INTERVAL)
+            return True
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_writer(fd)
+
     async def flush(self, timeout=None):
         to = serial.Timeout(timeout)
-        async with self.async_lock:
-            while self.in_waiting > 0:
-                if to.expired():
-                    raise serial.SerialTimeoutException('Flush timeout')
-                await asyncio.sleep(0.01)
+        while self.in_waiting > 0:
+            if to.expired():
+                raise serial.SerialTimeoutException('Flush timeout')
+            await asyncio.sleep(0.01)
 
     async def reset_input_buffer(self, timeout=None):
         """Clear input buffer, discarding all that is in the buffer."""
         to = serial.Timeout(timeout)
-        async with self.async_lock:
-            while self.in_waiting > 0:
-                super().reset_input_buffer()
-                if to.expired():
-                    raise serial.SerialTimeoutException('Read buffer reset timeout')
-                await asyncio.sleep(0)
+        self.buffer.clear()
+        self.tracker.clear()
+        while self.in_waiting > 0:
+            super().reset_input_buffer()
+            if to.expired():
+                raise serial.SerialTimeoutException('Read buffer reset timeout')
+            await asyncio.sleep(0)
 
     async def reset_output_buffer(self, timeout=None):
         """Clear output buffer, discarding all that is in the buffer."""
         to = serial.Timeout(timeout)
-        async with self.async_lock:
-            while self.out_waiting > 0:
-                super().reset_output_buffer()
-                if to.expired():
-                    raise serial.SerialTimeoutException('Write buffer reset timeout')
-                await asyncio.sleep(0)
+        while self.out_waiting > 0:
+            super().reset_output_buffer()
+            if to.expired():
+                raise serial.SerialTimeoutException('Write buffer reset timeout')
+            await asyncio.sleep(0)
@@ -10,6 +10,7 @@ from datetime import datetime
 
 from Async.AsyncSerial import *
 from EmulatedLambda import FakeComPort
+import GenesisCodec
 from serial import Timeout
 
 from TDKLambda import *
@@ -69,13 +70,17 @@ def async_yield():
 class FakeAsyncComPort(FakeComPort):
     SN = 9876543
     RESPONSE_DELAY = 0.0
+    POLL_INTERVAL = 0.005
 
     def __init__(self, port, *args, **kwargs):
         FakeComPort.SN = FakeAsyncComPort.SN
         FakeComPort.RESPONSE_DELAY = FakeAsyncComPort.RESPONSE_DELAY
         super().__init__(port, *args, **kwargs)
         self.async_lock = asyncio.Lock()
-        self.s = super()
+
+    @property
+    def ready(self):
+        return self.isOpen()
 
     async def reset_input_buffer(self, timeout=None):
         return True
@@ -93,38 +98,62 @@ class FakeAsyncComPort(FakeComPort):
         return v
 
     async def read_until(self, terminator=b'\r', size=None, timeout=None):
-        result = bytearray()
+        # emulated device returns whole response by one read
         to = Timeout(timeout)
         while True:
-            c = self.read(1)
-            if c:
-                result += c
-                if terminator in result:
-                    break
-                if size is not None and len(result) >= size:
-                    break
-                to.restart(timeout)
+            result = super().read()
+            if result:
+                return result
             if to.expired():
                 raise SerialTimeoutException('Read timeout')
-            await asyncio.sleep(0)
-        return bytes(result)
+            if self.last_write:
+                await asyncio.sleep(self.RESPONSE_DELAY)
+            else:
+                await asyncio.sleep(self.POLL_INTERVAL)
 
 
 class AsyncTDKLambda(TDKLambda):
     LOG_LEVEL = logging.DEBUG
     tasks = []
+    ports = {}
+
+    def __init__(self, port, addr, checksum=False, baud_rate=9600, logger=None, **kwargs):
+        # error counter for async reading
+        self.error_count = Counter(3)
+        super().__init__(port, addr, checksum, baud_rate, logger, **kwargs)
+
+    def create_com_port(self):
+        # async ports are shared by devices with the same port name
+        com = AsyncTDKLambda.ports.get(self.port)
+        if com is None or not com.isOpen():
+            try:
+                if self.port.startswith('FAKE'):
+                    com = FakeAsyncComPort(self.port)
+                else:
+                    com = AsyncSerial(self.port, baudrate=self.baud)
+                com._current_addr = -1
+                AsyncTDKLambda.ports[self.port] = com
+                self.logger.debug('Port %s is ready', self.port)
+            except:
+                self.logger.error('Port %s creation error', self.port)
+                self.logger.debug('', exc_info=True)
+                com = None
+        self.com = com
+        return com
 
     async def init(self):
+        # returns True if device has responded as TDK Lambda supply
         if self.com is None:
             self.suspend()
-            return
+            return False
         # set device address
-        response = await self._set_addr()
+        async with self.com.async_lock:
+            response = await self._set_addr()
         if not response:
             msg = 'Uninitialized TDKLambda device has been added to list'
             self.logger.info(msg)
             self.add_to_list()
-            return
+            return False
         # read device type
         self.id = await self.read_device_id()
         if self.id.find('LAMBDA') >= 0:
@@ -143,6 +172,7 @@ class AsyncTDKLambda(TDKLambda):
         self.add_to_list()
         msg = 'TDKLambda: %s SN:%s has been created' % (self.id, self.sn)
         self.logger.info(msg)
+        return self.id.find('LAMBDA') >= 0
 
     async def read_device_id(self):
         try:
@@ -165,6 +195,7 @@ class AsyncTDKLambda(TDKLambda):
             return -1
 
     async def _set_addr(self):
+        # port async_lock should be acquired by caller
         if self.com is None:
             self.logger.warning('%s port is not configured' % self.port)
             return False
@@ -173,59 +204,66 @@ class AsyncTDKLambda(TDKLambda):
         else:
             a0 = -1
         # a0 = self.com._current_addr
-        result = await self._send_command(b'ADR %d' % self.addr)
+        result = await self._exchange(self.prepare_command(b'ADR %d' % self.addr))
         if result and self.check_response(b'OK'):
             self.com._current_addr = self.addr
             self.logger.debug('Address %d -> %d' % (a0, self.addr))
             return True
         else:
             self.logger.error('Error set address %d -> %d' % (a0, self.addr))
-            # if self.com is not None:
-            #     self.com._current_addr = -1
+            self.com._current_addr = -1
             return False
 
     async def is_suspended(self):
-        if time.time() < self.suspend_to:   # if suspension does not expire
-            return True
-        else:                               # suspension expires
-            if self.suspend_flag:           # if it was suspended and expires
-                await self.reset()
-                if self.com is None:        # if initialization was not successful
-                    # suspend again
-                    self.suspend()
-                    return True
-                else:                       # initialization was successful
-                    self.unsuspend()
-                    return False
-            else:                           # it was not suspended
-                return False
+        if self.breaker.allow():
+            return False
+        if self.breaker.start_probe():
+            # recovery probe runs as separate task, commands are rejected meanwhile
+            asyncio.create_task(self.probe())
+        return True
+
+    async def probe(self):
+        # verdict is taken from initialization result, breaker may be reopened by port reset meanwhile
+        try:
+            result = await self.reset()
+        except:
+            self.logger.debug('Recovery probe error', exc_info=True)
+            result = False
+        if result:
+            self.unsuspend()
+        else:
+            self.suspend()
 
     @enterexit
     async def _send_command(self, cmd: bytes):
         self.logger.debug('++++++++++++++Entry %s', cmd)
         if not cmd.endswith(b'\r'):
             cmd += b'\r'
-        t1 = time.time()
+        if self.com.async_lock.locked():
+            self.logger.debug('\n***************** Locked %s %s\n', cmd, self.command)
+        async with self.com.async_lock:
+            return await self._exchange(cmd)
+
+    async def _exchange(self, cmd: bytes):
+        # one request - response transaction, port async_lock should be acquired by caller
+        result = False
         try:
-            # if cmd.startswith(b'PV ') or cmd.startswith(b'PC '):
-            #     self.logger.debug('***************************')
-                #self.response = b'OK\r'
-            if self.com.async_lock.locked():
-                self.logger.debug('\n***************** Locked %s %s\n', cmd, self.command)
-                #return False
-            async with self.com.async_lock:
-                t0 = time.time()
-                self.command = cmd
-                self.response = b''
-                # write command
-                if not await self.write(cmd):
-                    return False
-                # read response (to CR by default)
-                result = await self.read_response()
-                dt = (time.time() - t0) * 1000.0
-                dt1 = (time.time() - t1) * 1000.0
-                self.logger.debug('%s -> %s %s %4.0f ms %4.0f ms' % (cmd, self.response, result, dt, dt1))
-                return result
+            t0 = time.time()
+            self.command = cmd
+            self.response = b''
+            # write command
+            if not await self.write(cmd):
+                return False
+            # read response (to CR by default) with deadline learned for this command
+            self.read_timeout = self.latency.timeout(cmd)
+            result = await self.read_response()
+            if result:
+                self.latency.record(cmd, time.time() - t0)
+            else:
+                self.latency.missed(cmd)
+            dt = (time.time() - t0) * 1000.0
+            self.logger.debug('%s -> %s %s %4.0f ms' % (cmd, self.response, result, dt))
+            return result
         except:
             self.logger.debug("", exc_info=True)
             return result
@@ -237,25 +275,19 @@ class AsyncTDKLambda(TDKLambda):
             self.response = b''
             return False
         try:
-            # unify command
-            cmd = cmd.upper().strip()
-            # convert str to bytes
-            if isinstance(cmd, str):
-                cmd = str.encode(cmd)
-            # add checksum
-            if self.check:
-                cs = self.checksum(cmd[:-1])
-                cmd = b'%s$%s\r' % (cmd[:-1], cs)
-            if self.com._current_addr != self.addr:
-                result = await self._set_addr()
+            cmd = self.prepare_command(cmd)
+            # address selection and command are not interleaved with other devices on the port
+            async with self.com.async_lock:
+                if self.com._current_addr != self.addr:
+                    result = await self._set_addr()
+                    if not result:
+                        self.suspend()
+                        self.response = b''
+                        return False
+                result = await self._exchange(cmd)
                 if not result:
-                    self.suspend()
-                    self.response = b''
-                    return False
-            result = await self._send_command(cmd)
-            if not result:
-                self.logger.warning('Error executing %s, repeated' % cmd)
-                result = await self._send_command(cmd)
+                    self.logger.warning('Error executing %s, repeated' % cmd)
+                    result = await self._exchange(cmd)
             if not result:
                 self.logger.error('Repeated error executing %s' % cmd)
                 self.suspend()
@@ -275,9 +307,7 @@ class AsyncTDKLambda(TDKLambda):
     async def write(self, cmd):
         t0 = time.time()
         try:
-            # clear input buffer
-            await self.reset_input_buffer()
-            # write command
+            # write command, unread responses of previous commands are dropped by port
             length = await self.com.write(cmd)
             if len(cmd) == length:
                 result = True
@@ -307,37 +337,31 @@ class AsyncTDKLambda(TDKLambda):
         if not self.check:
             self.error_count.clear()
             return True
-        # checksum calculation and check
-        m = result.find(b'$')
-        if m < 0:
-            self.logger.error('No expected checksum in response')
+        # checksum check
+        end = GenesisCodec.payload_end(result, True)
+        if end < 0:
+            self.logger.error('%s in response %s' % (GenesisCodec.MESSAGES[end], result))
             self.error_count.inc()
             return False
-        else:
-            cs = self.checksum(result[:m])
-            if result[m+1:] != cs:
-                self.logger.error('Incorrect checksum')
-                self.error_count.inc()
-                return False
-            self.error_count.clear()
-            self.response = result[:m]
-            return True
+        self.error_count.clear()
+        self.response = result[:end]
+        return True
 
     async def read_until(self, terminator=b'\r', size=None):
-        result = b''
         t0 = time.time()
-        while not await self.is_suspended() and terminator not in result:
-            r = await self.read(1)
-            if len(r) <= 0:
-                self.suspend()
-                dt = (time.time() - t0) * 1000.0
-                self.logger.debug('Read error %s %4.0f ms', result, dt)
-                return result
-            result += r
-            if size is not None and len(result) >= size:
-                break
-        dt = (time.time() - t0) * 1000.0
-        self.logger.debug('%s %s bytes in %4.0f ms', result, len(result), dt)
+        try:
+            result = await self.com.read_until(terminator, size, self.read_timeout)
+        except SerialTimeoutException:
+            self.suspend()
+            dt = (time.time() - t0) * 1000.0
+            self.logger.debug('Reading timeout %4.0f ms', dt)
+            return b''
+        except:
+            self.suspend()
+            self.logger.info('Unexpected exception', exc_info=True)
+            return b''
+        dt = time.time() - t0
+        self.logger.debug('%s %s bytes in %4.0f ms', result, len(result), dt * 1000.0)
         return result
 
     async def read(self, size=1, retries=3):
@@ -345,18 +369,10 @@ class AsyncTDKLambda(TDKLambda):
         result = b''
         while counter <= retries:
             try:
-                t0 = time.time()
-                result = await self._read(size, self.read_timeout)
-                dt = time.time() - t0
-                new_timeout = min(max(2.0 * dt, self.min_timeout), self.max_timeout)
-                if new_timeout != self.read_timeout:
-                    self.read_timeout = min(max(2.0 * dt, self.min_timeout), self.max_timeout)
-                    self.logger.debug('read: %s timeout corrected to %5.2f s', result, self.read_timeout)
-                return result
+                return await self._read(size, self.read_timeout)
             except SerialTimeoutException:
                 counter += 1
-                self.read_timeout = min(1.5 * self.read_timeout, self.max_timeout)
-                self.logger.debug('Reading timeout - increased to %5.2f s', self.read_timeout)
+                self.logger.debug('Reading timeout')
             except:
                 counter = retries
                 self.logger.info('Unexpected exception', exc_info=True)
@@ -364,60 +380,47 @@ class AsyncTDKLambda(TDKLambda):
         return result
 
     async def _read(self, size=1, timeout=None):
-        result = b''
-        to = Timeout(timeout)
-        n = 0
-        while len(result) < size:
-            n += 1
-            r = self.com.s.read(1)
-            #r = await self.com.read(1)
-            if self.command.startswith(b'PV '):
-                self.logger.debug('OOOOOOOOOOOO')
-            if len(r) > 0:
-                result += r
-                to.restart(timeout)
-            else:
-                if to.expired():
-                    self.logger.debug('Read timeout')
-                    raise SerialTimeoutException('Read timeout')
-            await asyncio.sleep(0)
-        self.logger.debug('%d', n)
-        return result
+        return await self.com.read(size, timeout)
 
     async def read_float(self, cmd):
-        try:
-            if not await self.send_command(cmd):
-                return float('Nan')
-            v = float(self.response)
-        except:
-            self.logger.debug('%s is not a float', self.response)
-            v = float('Nan')
+        if not await self.send_command(cmd):
+            return float('Nan')
+        code, v = GenesisCodec.decode_float(self.response)
+        if code < 0:
+            self.logger.debug('%s is not a float' % self.response)
         return v
 
     async def read_all(self):
+        # values are decoded into preallocated array
         if not await self.send_command(b'DVC?'):
-            return [float('Nan')] * 6
-        reply = self.response
-        sv = reply.split(b',')
-        vals = []
-        for s in sv:
-            try:
-                v = float(s)
-            except:
-                self.logger.debug('%s is not a float', reply)
-                v = float('Nan')
-            vals.append(v)
-        if len(vals) <= 6:
-            return vals
+            code = GenesisCodec.decode_floats(b'', self.values)
         else:
-            return vals[:6]
+            code = GenesisCodec.decode_floats(self.response, self.values)
+            if code < 0:
+                self.logger.debug('%s %s' % (GenesisCodec.MESSAGES[code], self.response))
+        return self.values
+
+    async def read_status(self):
+        # STT? decoded into preallocated array, SR and FR registers are -1 on error
+        if not await self.send_command(b'STT?'):
+            code = GenesisCodec.decode_status(b'', self.status)
+        else:
+            code = GenesisCodec.decode_status(self.response, self.status)
+            if code < 0:
+                self.logger.debug('%s %s' % (GenesisCodec.MESSAGES[code], self.response))
+        return self.status
 
     async def read_value(self, cmd, v_type=type(str)):
         try:
-            if await self.send_command(cmd):
-                v = v_type(self.response)
-            else:
+            if not await self.send_command(cmd):
                 v = None
+            elif v_type is float:
+                code, v = GenesisCodec.decode_float(self.response)
+                if code < 0:
+                    self.logger.info('Can not convert %s to %s' % (self.response, v_type))
+                    v = None
+            else:
+                v = v_type(self.response)
         except:
             self.logger.info('Can not convert %s to %s' % (self.response, v_type))
             v = None
@@ -479,11 +482,11 @@ class AsyncTDKLambda(TDKLambda):
         return await self.read_value(b'PV?', v_type=float)
 
     async def reset(self):
+        # returns initialization result
         self.logger.debug('Resetting %s' % self)
         if self.com is None:
             self.create_com_port()
-            await self.init()
-            return
+            return await self.init()
         # check working devices on same port
         for d in TDKLambda.devices:
             if d.port == self.port and d.initialized() and d != self:
@@ -492,13 +495,11 @@ class AsyncTDKLambda(TDKLambda):
                 else:
                     did = d.read_device_id()
                 if not did.startswith('Unknown'):
-                    await self.init()
-                    return
+                    return await self.init()
         # no working devices on same port so try to recreate com port
         self.close_com_port()
         self.create_com_port()
-        await self.init()
-        return
+        return await self.init()
 
     def create_task(self, action):
         task1 = asyncio.create_task(action)
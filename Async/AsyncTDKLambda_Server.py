@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 """TDK Lambda Genesis series power supply tango device server"""
 from Async.AsyncTDKLambda import AsyncTDKLambda
+from CircuitBreaker import CircuitBreaker
 
 import logging
 import time
+from array import array
 from math import isnan
 import sys
 import asyncio
@@ -39,6 +41,16 @@ class Async_TDKLambda_Server(Device):
     #reen_mode = GreenMode.Synchronous
 
     READING_VALID_TIME = 3.0
+    # protection limits OVP and UVL are read by DVC? only if they are older
+    LIMITS_VALID_TIME = 10.0
+    # snapshot quality flags
+    SNAPSHOT_INVALID = 1
+    SNAPSHOT_STALE = 2
+    SNAPSHOT_OUTPUT_ON = 4
+    SNAPSHOT_FAULT = 8
+    SNAPSHOT_SUSPENDED = 16
+    # bus snapshot rows, numpy.frombuffer(data).reshape(-1, 11)
+    BUS_SNAPSHOT_FORMAT = 'float64 addr,mv,pv,mc,pc,ovp,uvl,sr,fr,time,flags'
     devices = []
 
     device_type = attribute(label="PS Type", dtype=str,
@@ -93,6 +105,19 @@ class Async_TDKLambda_Server(Device):
                                    min_value=0.0,
                                    doc="Programmed current")
 
+    snapshot = attribute(label="Snapshot", dtype=(float,), max_dim_x=10,
+                         display_level=DispLevel.OPERATOR,
+                         access=AttrWriteType.READ,
+                         unit="", format="%s",
+                         doc="DVC? values MV, PV, MC, PC, OVP, UVL, STT? registers SR, FR, time, quality flags "
+                             "(1 invalid, 2 stale, 4 output on, 8 fault bit of SR, 16 suspended)")
+
+    bus_snapshot = attribute(label="Bus Snapshot", dtype=tango.DevEncoded,
+                             display_level=DispLevel.OPERATOR,
+                             access=AttrWriteType.READ,
+                             doc="Snapshot rows of all supplies of the port, native float64 "
+                                 "addr, MV, PV, MC, PC, OVP, UVL, SR, FR, time, quality flags")
+
     def get_device_property(self, prop: str, default=None):
         name = self.get_name()
         # create device proxy
@@ -118,8 +143,13 @@ class Async_TDKLambda_Server(Device):
         #self.lock = asyncio.Lock()
         self.lock = threading.Lock()
         self.task = None
+        # latest not written values and their writer tasks by command
+        self.queued = {}
+        self.writers = {}
         self.error_count = 0
-        self.values = [float('NaN')] * 6
+        # MV, PV, MC, PC, OVP, UVL, SR, FR
+        self.values = [float('NaN')] * 8
+        self.limits_time = 0.0
         self.time = time.time() - self.READING_VALID_TIME - 1.0
         self.timeval = tango.TimeVal.now()
         self.set_state(DevState.INIT)
@@ -223,10 +253,18 @@ class Async_TDKLambda_Server(Device):
     async def read_all(self):
         t0 = time.time()
         try:
-            values = await self.tdk.read_all()
+            # STT? gives measured and programmed values with status and fault registers
+            values = await self.tdk.read_status()
+            limits = self.values[4:6]
+            if values[4] >= 0 and time.time() - self.limits_time > self.LIMITS_VALID_TIME:
+                # protection limits are changed rarely, DVC? is not read every time
+                limits = list((await self.tdk.read_all())[4:6])
+                if not any(isnan(v) for v in limits):
+                    self.limits_time = time.time()
             self.time = time.time()
             self.timeval = tango.TimeVal.now()
-            self.values = values
+            # decoded in place by the next reading, copy is kept
+            self.values = [*values[:4], *limits, values[4], values[5]]
             msg = '%s:%d read_all %s ms %s' % \
                   (self.tdk.port, self.tdk.addr, int((self.time - t0) * 1000.0), values)
             self.logger.debug(msg)
@@ -289,32 +327,70 @@ class Async_TDKLambda_Server(Device):
             self.logger.debug('++++++++++++In Lock+++++++++++')
             return await self.read_one(attr, 3, "Programmed current read error")
 
+    def snapshot_row(self):
+        row = [*self.values, self.time]
+        flags = 0
+        if any(isnan(v) for v in row[:4]):
+            flags |= self.SNAPSHOT_INVALID
+        if time.time() - self.time > self.READING_VALID_TIME:
+            flags |= self.SNAPSHOT_STALE
+        # SR is -1 if STT? failed, CV or CC bit is set if output is on
+        if row[6] >= 0 and int(row[6]) & 0x03:
+            flags |= self.SNAPSHOT_OUTPUT_ON
+        if row[6] >= 0 and int(row[6]) & 0x08:
+            flags |= self.SNAPSHOT_FAULT
+        if self.tdk.breaker.state != CircuitBreaker.CLOSED:
+            flags |= self.SNAPSHOT_SUSPENDED
+        row.append(float(flags))
+        return row
+
+    async def read_snapshot(self):
+        # one STT? for all values of the device
+        await self.attrib_r_wrapper(self.read_all(), valid_time=self.READING_VALID_TIME)
+        return self.snapshot_row()
+
+    async def read_bus_snapshot(self):
+        # all devices of the port by one attribute read
+        devices = [d for d in Async_TDKLambda_Server.devices if d.tdk.port == self.tdk.port]
+        if self not in devices:
+            devices.append(self)
+        devices.sort(key=lambda d: d.tdk.addr)
+        data = array('d')
+        for d in devices:
+            await d.attrib_r_wrapper(d.read_all(), valid_time=d.READING_VALID_TIME)
+            data.append(d.tdk.addr)
+            data.extend(d.snapshot_row())
+        return self.BUS_SNAPSHOT_FORMAT, data.tobytes()
+
     async def write_one(self, attrib, value, cmd, message):
-        result = False
-        try:
-            if not self.tdk.initialized():
-                attrib.set_quality(tango.AttrQuality.ATTR_INVALID)
-                msg = "%s Writing to offline device" % self
-                #self.info_stream(msg)
-                self.logger.warning(msg)
-                result = False
-                self.set_fault()
-            else:
-                if self.task is not None and not self.task.done():
-                    self.logger.debug('============Awaiting task 1 %s', self.task)
-                    await self.task
-                    self.logger.debug('============Awaited 1')
+        # value is queued without waiting for the device, newer value of a slider burst
+        # replaces the queued one and only the latest value is written by write_latest
+        if not self.tdk.initialized():
+            attrib.set_quality(tango.AttrQuality.ATTR_INVALID)
+            msg = "%s Writing to offline device" % self
+            self.logger.warning(msg)
+            self.set_fault()
+            return False
+        self.queued[cmd] = value
+        writer = self.writers.get(cmd)
+        if writer is None or writer.done():
+            self.writers[cmd] = asyncio.create_task(self.write_latest(attrib, cmd, message))
+        return True
+
+    async def write_latest(self, attrib, cmd, message):
+        # writer of one parameter, runs while new values are queued
+        while cmd in self.queued:
+            result = False
+            try:
+                while self.task is not None and not self.task.done():
+                    await asyncio.wait({self.task})
+                # value queued while waiting for the port is taken
+                value = self.queued.pop(cmd)
                 self.task = asyncio.create_task(self.tdk.write_value(cmd, value))
-                self.logger.debug('============Awaiting task 2 %s', self.task)
-                await self.task
-                self.logger.debug('============Awaited 2')
-                if self.task.cancelled():
-                    self.logger.warning('Task %s was cancelled', self.task)
-                ex = self.task.exception()
-                if ex is not None:
-                    self.logger.warning('Exception %s executing Task %s', ex, self.task)
-                    raise ex
+                await asyncio.wait({self.task})
                 result = self.task.result()
+            except:
+                self.logger.debug("Task %s error", self.task, exc_info=True)
             if result:
                 attrib.set_quality(tango.AttrQuality.ATTR_VALID)
                 self.set_running()
@@ -324,16 +400,6 @@ class Async_TDKLambda_Server(Device):
                 self.logger.warning(msg)
                 self.info_stream(msg)
                 self.set_fault()
-            return result
-        except:
-            self.logger.warning('Exception %s Task %s', sys.exc_info()[0], self.task)
-            attrib.set_quality(tango.AttrQuality.ATTR_INVALID)
-            msg = ('%s ' + message) % self
-            self.logger.warning(msg)
-            self.info_stream(msg)
-            self.logger.debug(" ", exc_info=True)
-            self.set_fault()
-            return result
 
     async def write_programmed_voltage(self, value):
         self.logger.debug('------------Entry----------')
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Bus multiplexer: owns serial port and serves Genesis frames to several processes over ipc:// socket"""
+
+import asyncio
+import logging
+import os
+import socket
+import sys
+
+from TDKLambda import TDKLambda, ComPort, ipc_address
+
+CR = b'\r'
+
+
+class BusDaemon:
+    TIMEOUT = 0.5
+
+    def __init__(self, port, address, timeout=TIMEOUT, **kwargs):
+        self.logger = logging.getLogger('BusDaemon')
+        self.com = ComPort(port, **kwargs)
+        self.address = address
+        self.timeout = timeout
+        self.stats = {'clients': 0, 'requests': 0, 'timeouts': 0}
+
+    async def serve(self):
+        family, address = ipc_address(self.address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.remove(address)
+            server = await asyncio.start_unix_server(self.client, address)
+        else:
+            server = await asyncio.start_server(self.client, *address)
+        self.logger.info('Serving %s at ipc://%s', self.com.port, self.address)
+        async with server:
+            await server.serve_forever()
+
+    async def client(self, reader, writer):
+        # every client has its own selected address, bus address is switched by reactor when needed
+        self.stats['clients'] += 1
+        addr = -1
+        adr = b''
+        try:
+            while True:
+                frame = await reader.readuntil(CR)
+                body = frame[:-1]
+                m = body.find(b'$')
+                cmd = (body[:m] if m >= 0 else body).strip().upper()
+                if cmd.startswith(b'ADR '):
+                    try:
+                        addr = int(cmd[4:])
+                        adr = frame
+                        reply = b'OK'
+                    except:
+                        reply = b'C03'
+                    if m >= 0:
+                        reply += b'$' + TDKLambda.checksum(reply)
+                    writer.write(reply + CR)
+                    continue
+                response = await self.request(frame, addr, adr)
+                if response:
+                    writer.write(response)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.stats['clients'] -= 1
+            writer.close()
+
+    async def request(self, frame, addr, adr):
+        # identical queries of several clients are executed once by the port
+        self.stats['requests'] += 1
+        try:
+            response = await asyncio.wrap_future(self.com.submit(frame, addr, adr, self.timeout))
+        except:
+            self.logger.debug('Request %s error', frame, exc_info=True)
+            response = b''
+        if not response:
+            self.stats['timeouts'] += 1
+        return response
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print('Use: BusDaemon.py <serial port> <socket path or host:port> [baudrate]')
+        exit(-1)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-7s %(name)s %(message)s')
+    baud = int(sys.argv[3]) if len(sys.argv) > 3 else 9600
+    daemon = BusDaemon(sys.argv[1], sys.argv[2], baudrate=baud)
+    asyncio.run(daemon.serve())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import random
+import time
+from threading import Lock
+
+
+class CircuitBreaker:
+    # Closed - requests pass. Open - requests are rejected at once until backoff expires.
+    # Half-open - single recovery probe runs in background, other requests are still rejected.
+    # Probe success closes breaker, failure opens it again with doubled backoff.
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name='', base=0.5, maximum=30.0, jitter=0.2):
+        self.name = name
+        self.base = base
+        self.maximum = maximum
+        self.jitter = jitter
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0       # consecutive openings without successful probe
+        self.open_to = 0.0
+        self.probe = None       # thread ident of running probe
+        self.lock = Lock()
+        self.transitions = {}   # 'closed->open' -> count
+        self.rejected = 0
+
+    def __str__(self):
+        return '%s %s' % (self.name, self.state)
+
+    def set_state(self, state):
+        if state != self.state:
+            key = '%s->%s' % (self.state, state)
+            self.transitions[key] = self.transitions.get(key, 0) + 1
+            self.state = state
+
+    def backoff(self):
+        t = min(self.base * 2 ** (self.failures - 1), self.maximum)
+        return t * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+    def open(self, duration=None):
+        # open or reopen, returns backoff time
+        with self.lock:
+            self.failures += 1
+            if duration is None:
+                duration = self.backoff()
+            self.open_to = time.time() + duration
+            self.probe = None
+            self.set_state(CircuitBreaker.OPEN)
+            return duration
+
+    def close(self):
+        with self.lock:
+            self.failures = 0
+            self.probe = None
+            self.set_state(CircuitBreaker.CLOSED)
+
+    def start_probe(self):
+        # switch expired open breaker to half-open, True if probe should be started by caller,
+        # probe thread sets self.probe to its ident
+        with self.lock:
+            if self.state != CircuitBreaker.OPEN or time.time() < self.open_to:
+                return False
+            self.probe = None
+            self.set_state(CircuitBreaker.HALF_OPEN)
+            return True
+
+    def allow(self, ident=None):
+        # fast check on request path, only probe thread passes half-open breaker
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        if self.state == CircuitBreaker.HALF_OPEN and ident is not None and ident == self.probe:
+            return True
+        self.rejected += 1
+        return False
+
+    def expired(self):
+        return self.state == CircuitBreaker.OPEN and time.time() >= self.open_to
+
+    def remaining(self):
+        if self.state != CircuitBreaker.OPEN:
+            return 0.0
+        return max(self.open_to - time.time(), 0.0)
+
+    def info(self):
+        return {'state': self.state, 'failures': self.failures, 'remaining': self.remaining(),
+                'rejected': self.rejected, 'transitions': dict(self.transitions)}
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import selectors
+import socket
+import time
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Lock
+
+import GenesisCodec
+
+CR = b'\r'
+
+
+class Transaction:
+    def __init__(self, cmd, addr=-1, adr=b'', timeout=0.5, reply=True):
+        self.command = cmd          # prepared command frame
+        self.addr = addr            # device address, -1 if address should not be selected
+        self.adr = adr              # prepared ADR frame to select address
+        self.timeout = timeout      # response timeout for every written frame
+        self.reply = reply          # False for global commands, port is held for timeout after write
+        self.future = Future()
+        self.steps = deque()        # frames to be written one after another
+        self.expected = 0           # responses expected for the written step
+        self.adr_sent = False
+        self.responses = []
+        self.deadline = 0.0
+        self.time = time.time()
+        self.started = 0.0          # time of the last write
+        self.elapsed = 0.0          # from the last write to completion
+        self.time_end = 0.0
+        self.superseded_by = None   # newer setting of the same parameter executed instead
+
+
+class ComReactor:
+    # One thread services all ports: transactions of different ports run concurrently,
+    # transactions of one port run one by one in order of submission.
+    POLL_INTERVAL = 0.002       # for ports without selectable handle
+    MAX_BATCH = 8               # transactions for selected address served while other address waits
+    LATE_GUARD = 0.02           # port hold time after timeout, transaction timeout if it is longer,
+    MAX_LATE_GUARD = 0.1        # so late response is not taken by the next command
+    _reactor = None
+    _reactor_lock = Lock()
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.ports = {}         # port -> registered file descriptor or None
+        self.lock = Lock()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+        self.logger = logging.getLogger(__name__)
+        self.thread = Thread(target=self.run, name='ComReactor', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def get():
+        with ComReactor._reactor_lock:
+            if ComReactor._reactor is None:
+                ComReactor._reactor = ComReactor()
+            return ComReactor._reactor
+
+    def submit(self, port, transaction):
+        # returns transaction which will be executed: the submitted one, or identical query
+        # already queued or in progress (single-flight), all waiters get the same response
+        with self.lock:
+            if port not in self.ports:
+                self.ports[port] = None
+            shared = self.pending(port, transaction)
+            if shared is not None:
+                port.schedule['coalesced'] += 1
+                return shared
+            self.combine(port, transaction)
+            port.queue.append(transaction)
+        self.wakeup()
+        return transaction
+
+    @staticmethod
+    def pending(port, tr):
+        if b'?' not in tr.command:
+            return None
+        # query is not shared with one submitted before a setting command to the same address
+        for t in (*reversed(port.queue), port.active):
+            if t is None or t.addr != tr.addr:
+                continue
+            if t.command == tr.command:
+                return None if t.future.done() else t
+            if b'?' not in t.command:
+                return None
+        return None
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except:
+                # reactor thread is kept running, transactions are completed by their deadlines
+                self.logger.error('Reactor error', exc_info=True)
+                time.sleep(self.POLL_INTERVAL)
+
+    def run_once(self):
+        timeout = self.service()
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                try:
+                    while self.wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            port = key.data
+            if port.active is not None:
+                try:
+                    port.fill()
+                except Exception as ex:
+                    self.complete(port, port.active, exception=ex)
+
+    def service(self):
+        # returns time to the nearest deadline or poll
+        timeout = None
+        with self.lock:
+            ports = list(self.ports)
+        for port in ports:
+            try:
+                t = self.service_port(port)
+            except Exception as ex:
+                self.logger.debug('Port %s service error', port.port, exc_info=True)
+                if port.active is not None:
+                    self.complete(port, port.active, exception=ex)
+                t = 0.0
+            if t is not None and (timeout is None or t < timeout):
+                timeout = t
+        return timeout
+
+    def service_port(self, port):
+        tr = port.active
+        if tr is not None:
+            if self.ports.get(port) is None:
+                port.fill()
+            frame = port.take()
+            while frame is not None and tr is port.active:
+                self.received(port, tr, frame)
+                frame = port.take() if tr is port.active else None
+        if port.active is None:
+            if not port.queue:
+                return None
+            guard = port.tracker.guard()
+            if guard > 0.0:
+                # late response of timed out request may still arrive
+                return guard
+            if not port.lock.acquire(blocking=False):
+                # port is used by a blocking caller
+                return self.POLL_INTERVAL
+            with self.lock:
+                tr = self.next_transaction(port)
+            self.start(port, tr)
+        tr = port.active
+        if tr is None:
+            return 0.0
+        remaining = tr.deadline - time.perf_counter()
+        if remaining <= 0.0:
+            if tr.expected > 0:
+                port.tracker.timed_out(min(max(tr.timeout, self.LATE_GUARD), self.MAX_LATE_GUARD))
+                if tr.adr_sent and not tr.responses:
+                    # address selection state is unknown
+                    port.current_addr = -1
+            self.complete(port, tr, b'')
+            return 0.0
+        if self.ports.get(port) is None:
+            return min(remaining, self.POLL_INTERVAL)
+        return remaining
+
+    @staticmethod
+    def combine(port, tr):
+        # Latest wins: waiting setting of the same parameter of the device is removed from the queue
+        # and completed with the result of the new one. Settings of other parameters may be
+        # between them, query or command without value keeps the order.
+        if tr.addr < 0 or b'?' in tr.command or b' ' not in tr.command:
+            return
+        key = tr.command.split(b' ')[0]
+        queue = port.queue
+        for i in range(len(queue) - 1, -1, -1):
+            t = queue[i]
+            if t.addr != tr.addr:
+                continue
+            if b'?' in t.command or b' ' not in t.command:
+                return
+            if t.command.split(b' ')[0] == key:
+                del queue[i]
+                t.superseded_by = tr
+                tr.future.add_done_callback(lambda f: ComReactor.supersede(t, tr))
+                port.schedule['combined'] += 1
+                return
+
+    @staticmethod
+    def supersede(t, tr):
+        t.elapsed = tr.elapsed
+        t.time_end = tr.time_end
+        t.responses = tr.responses
+        if tr.future.exception() is not None:
+            t.future.set_exception(tr.future.exception())
+        else:
+            t.future.set_result(tr.future.result())
+
+    @staticmethod
+    def needs_adr(port, tr):
+        return tr.addr >= 0 and tr.adr and port.current_addr != tr.addr
+
+    def next_transaction(self, port):
+        # Transactions for the selected address go first, so ADR is not sent for every command
+        # on a multi-drop bus. Order for every address is kept, the queue head waits for
+        # MAX_BATCH transactions at most. Transaction without address (global command or raw
+        # frame) is never passed.
+        queue = port.queue
+        if port.current_addr >= 0 and port.batch < self.MAX_BATCH and self.needs_adr(port, queue[0]):
+            for i, tr in enumerate(queue):
+                if tr.addr < 0:
+                    break
+                if tr.addr == port.current_addr:
+                    del queue[i]
+                    port.batch += 1
+                    port.schedule['adr_avoided'] += 1
+                    return tr
+        port.batch = 0
+        return queue.popleft()
+
+    def start(self, port, tr):
+        port.active = tr
+        self.register(port)
+        if tr.command == tr.adr:
+            # explicit address selection, written even if the address is selected
+            tr.adr_sent = True
+            tr.steps.append(tr.command)
+        elif self.needs_adr(port, tr):
+            tr.adr_sent = True
+            port.schedule['adr_switches'] += 1
+            if port.coalesce:
+                tr.steps.append(tr.adr + tr.command)
+            else:
+                tr.steps.append(tr.adr)
+                tr.steps.append(tr.command)
+        else:
+            tr.steps.append(tr.command)
+        self.write_step(port, tr)
+
+    def write_step(self, port, tr):
+        data = tr.steps.popleft()
+        tr.expected = data.count(CR) if tr.reply else 0
+        tr.started = time.perf_counter()
+        tr.deadline = tr.started + tr.timeout
+        if port.write(data) != len(data):
+            port.current_addr = -1
+            self.complete(port, tr, b'')
+
+    def received(self, port, tr, frame):
+        if tr.expected <= 0:
+            # nothing is expected after global command
+            port.tracker.unread(frame)
+            return
+        if not GenesisCodec.reply_matches(tr.adr if tr.adr_sent and not tr.responses else tr.command, frame):
+            # late response of timed out request, response is still expected
+            port.tracker.rejected(frame)
+            return
+        tr.responses.append(frame)
+        tr.expected -= 1
+        if tr.adr_sent and len(tr.responses) == 1:
+            # response to ADR
+            if not frame.startswith(b'OK'):
+                port.current_addr = -1
+                self.complete(port, tr, b'')
+                return
+            port.current_addr = tr.addr
+        if tr.expected > 0:
+            return
+        if tr.steps:
+            self.write_step(port, tr)
+        else:
+            self.complete(port, tr, frame)
+
+    def complete(self, port, tr, result=b'', exception=None):
+        if port.active is tr:
+            port.active = None
+            self.unregister(port)
+            port.lock.release()
+        if tr.future.done():
+            return
+        tr.elapsed = time.perf_counter() - tr.started
+        tr.time_end = time.time()
+        # passive liveness of addressed device
+        addr = tr.addr if tr.addr >= 0 else port.current_addr
+        if result:
+            port.seen[addr] = tr.time_end
+        elif tr.reply and exception is None:
+            port.seen.pop(addr, None)
+        if exception is not None:
+            tr.future.set_exception(exception)
+        else:
+            tr.future.set_result(result)
+
+    def register(self, port):
+        fd = port.fileno()
+        if fd is not None:
+            try:
+                self.selector.register(fd, selectors.EVENT_READ, port)
+            except (KeyError, ValueError, OSError):
+                fd = None
+        self.ports[port] = fd
+
+    def unregister(self, port):
+        fd = self.ports.get(port)
+        if fd is not None:
+            try:
+                self.selector.unregister(fd)
+            except (KeyError, ValueError, OSError):
+                pass
+        self.ports[port] = None
@@ -8,6 +8,7 @@ class FakeComPort:
     SN = 123456
     RESPONSE_DELAY = 0.035
     ID = b'FAKELAMBDA GEN10-100'
+    GLOBAL_COMMANDS = True
 
     def __init__(self, port, *args, **kwargs):
         self.port = port
@@ -25,6 +26,10 @@ class FakeComPort:
         self.id = {self.last_address: FakeComPort.ID}
         self.t = {self.last_address: time.perf_counter()}
         self.write_error = False
+        # fault register and enable registers, pending service requests
+        self.fr = {}
+        self.fena = {}
+        self.srq = b''
 
     def close(self):
         self.last_write = b''
@@ -46,10 +51,17 @@ class FakeComPort:
                     self.sn[self.last_address] = str(FakeComPort.SN).encode()
                     FakeComPort.SN += 1
                     self.id[self.last_address] = self.id[-1]
+            elif self.last_write.startswith(b'G'):
+                # global commands, no response
+                self.write_global(cmd)
             elif self.last_write.startswith(b'PV '):
                 self.pv[self.last_address] = float(cmd[3:])
             elif self.last_write.startswith(b'PC '):
                 self.pc[self.last_address] = float(cmd[3:])
+            elif self.last_write.startswith(b'FENA '):
+                self.fena[self.last_address] = int(cmd[5:], 16)
+            elif self.last_write.startswith(b'SENA '):
+                pass
             elif self.last_write.startswith(b'OUT ON') or self.last_write.startswith(b'OUT 1'):
                 self.out[self.last_address] = True
             elif self.last_write.startswith(b'OUT OF') or self.last_write.startswith(b'OUT 0'):
@@ -65,9 +77,33 @@ class FakeComPort:
             self.t[self.last_address] = time.perf_counter()
             return len(cmd)
 
+    def write_global(self, cmd):
+        if not self.GLOBAL_COMMANDS:
+            self.write_error = True
+            return
+        for a in self.pv:
+            if cmd.startswith(b'GPV '):
+                self.pv[a] = float(cmd[4:])
+            elif cmd.startswith(b'GPC '):
+                self.pc[a] = float(cmd[4:])
+            elif cmd.startswith(b'GOUT '):
+                self.out[a] = cmd[5:].strip() in (b'ON', b'1')
+            elif cmd.startswith(b'GRST'):
+                self.out[a] = False
+        self.last_write = b''
+
+    def trip(self, addr, fault=0x10):
+        # emulate fault (OVP by default), output is switched off, service request is sent if enabled
+        self.out[addr] = False
+        self.fr[addr] = self.fr.get(addr, 0) | fault
+        if self.fena.get(addr, 0) & fault:
+            self.srq += b'!%02d\r' % addr
+
     def read(self, size=1, timeout=None):
         if self.last_write == b'':
-            return b''
+            result = self.srq
+            self.srq = b''
+            return result
         if time.perf_counter() - self.t[self.last_address] < self.RESPONSE_DELAY:
             return b''
         self.t[self.last_address] = time.perf_counter()
@@ -123,6 +159,20 @@ class FakeComPort:
         if self.last_write.startswith(b'SN?'):
             self.last_write = b''
             return self.sn[self.last_address] + b'\r'
+        if self.last_write.startswith(b'STT?'):
+            a = self.last_address
+            self.last_write = b''
+            sr = 0x05 if self.out[a] else 0x04
+            if self.fr.get(a, 0):
+                sr = 0x08
+            return b'MV(%f),PV(%f),MC(%f),PC(%f),SR(%02X),FR(%02X)\r' % \
+                   (self.mv[a], self.pv[a], self.mc[a], self.pc[a], sr, self.fr.get(a, 0))
+        if self.last_write.startswith(b'FEVE?'):
+            self.last_write = b''
+            return b'%02X\r' % self.fr.pop(self.last_address, 0)
+        if self.last_write.startswith(b'SEVE?'):
+            self.last_write = b''
+            return b'00\r'
         if self.last_write.startswith(b'OUT?'):
             self.last_write = b''
             if self.out[self.last_address]:
@@ -132,6 +182,22 @@ class FakeComPort:
         self.last_write = b''
         return b'OK\r'
 
+    def wait(self, timeout=None):
+        # sleep until response is ready or timeout expires
+        if self.last_write == b'':
+            if self.srq:
+                return True
+            if timeout is not None:
+                time.sleep(timeout)
+            return False
+        delay = self.RESPONSE_DELAY - (time.perf_counter() - self.t[self.last_address])
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            return False
+        if delay > 0.0:
+            time.sleep(delay)
+        return True
+
     def reset_input_buffer(self, timeout=None):
         return True
 
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import deque
+
+CR = b'\r'
+
+
+class FrameTracker:
+    # Genesis responses carry no request id, so responses are matched to requests by order.
+    # Timed out requests are kept for LATE_TIME, frames left unread before the next write
+    # are counted as late responses of them, as SRQ messages, or as stale garbage.
+    LATE_TIME = 2.0
+    GLOBAL_COMMANDS = (b'GRST', b'GPV', b'GPC', b'GOUT', b'GSAV', b'GRCL')    # without response
+
+    def __init__(self):
+        self.requests = deque()     # (address, frame, time) written and waiting for response
+        self.expired = deque()      # timed out requests which may still be answered
+        self.late = {}              # late responses count by device address
+        self.srq = set()            # addresses of received service requests
+        self.guard_to = 0.0         # port is held after timeout while late response may arrive
+        self.last = None            # request of the last taken frame
+        self.stats = {'responses': 0, 'timeouts': 0, 'late': 0, 'stale': 0, 'srq': 0, 'lost': 0}
+
+    def written(self, data, addr=-1):
+        t = time.time()
+        for frame in data.split(CR)[:-1]:
+            if frame.startswith(b'ADR '):
+                try:
+                    addr = int(frame[4:].split(b'$')[0])
+                except:
+                    pass
+            elif frame.startswith(self.GLOBAL_COMMANDS):
+                continue
+            self.requests.append((addr, frame, t))
+
+    def answered(self):
+        self.stats['responses'] += 1
+        self.last = self.requests.popleft() if self.requests else None
+
+    def rejected(self, frame):
+        # taken frame does not fit its request, it is late response of expired one or garbage
+        self.stats['responses'] -= 1
+        if self.last is not None:
+            self.requests.appendleft(self.last)
+            self.last = None
+        return self.unread(frame)
+
+    def timed_out(self, guard=0.0):
+        self.stats['timeouts'] += 1
+        self.expired.extend(self.requests)
+        self.requests.clear()
+        self.guard_to = time.time() + guard
+
+    def guard(self):
+        # time to hold the port before the next write
+        if not self.expired:
+            return 0.0
+        return max(self.guard_to - time.time(), 0.0)
+
+    def expire(self):
+        # requests which were not read become expired, too old expired requests are lost
+        self.expired.extend(self.requests)
+        self.requests.clear()
+        t = time.time()
+        while self.expired and t - self.expired[0][2] > self.LATE_TIME:
+            self.expired.popleft()
+            self.stats['lost'] += 1
+        return len(self.expired) > 0
+
+    def unread(self, frame):
+        # classify frame that was not read by its request
+        if frame.startswith(b'!'):
+            self.stats['srq'] += 1
+            try:
+                self.srq.add(int(frame[1:3]))
+            except:
+                pass
+            return 'srq'
+        if self.expired:
+            addr = self.expired.popleft()[0]
+            self.late[addr] = self.late.get(addr, 0) + 1
+            self.stats['late'] += 1
+            return 'late'
+        self.stats['stale'] += 1
+        return 'stale'
+
+    def discard(self, buffer):
+        # classify and remove all frames from receive buffer (bytearray)
+        if not buffer:
+            return
+        frames = buffer.split(CR)
+        for frame in frames[:-1]:
+            self.unread(frame)
+        if frames[-1]:
+            self.stats['stale'] += 1
+        buffer.clear()
+
+    def clear(self):
+        self.requests.clear()
+        self.expired.clear()
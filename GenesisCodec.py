@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Genesis reply decoding from receive buffer (bytes or bytearray) into preallocated arrays.
+# Errors are returned as negative result codes, exceptions are not raised.
+
+import re
+from array import array
+
+NAN = float('nan')
+
+OK = 0
+NO_CR = -1
+NO_CHECKSUM = -2
+BAD_CHECKSUM = -3
+BAD_NUMBER = -4
+TOO_FEW = -5
+
+MESSAGES = {OK: 'OK', NO_CR: 'No CR', NO_CHECKSUM: 'No expected checksum', BAD_CHECKSUM: 'Incorrect checksum',
+            BAD_NUMBER: 'Not a number', TOO_FEW: 'Too few values'}
+
+_NUMBER = rb'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+_status = re.compile(rb'\s*MV\(([^)]*)\),\s*PV\(([^)]*)\),\s*MC\(([^)]*)\),\s*PC\(([^)]*)\),'
+                     rb'\s*SR\(([0-9A-Fa-f]{1,2})\),\s*FR\(([0-9A-Fa-f]{1,2})\)')
+# status (SR) and fault (FR) register bits
+SR_FLAGS = ('CV', 'CC', 'NFLT', 'FLT', 'AST', 'FDE', '', 'LCL')
+FR_FLAGS = ('', 'AC', 'OTP', 'FOLD', 'OVP', 'SO', 'OFF', 'ENA')
+_field = re.compile(rb' *(' + _NUMBER + rb') *(?:,|$)')
+_skip = re.compile(rb'[^,]*,?')
+
+
+def checksum(data, start=0, end=None):
+    if end is None:
+        end = len(data)
+    return b'%02X' % (sum(memoryview(data)[start:end]) & 0xFF)
+
+
+def frame(cmd, check=False):
+    # command frame with optional checksum and CR
+    if check:
+        return cmd + b'$' + checksum(cmd) + b'\r'
+    return cmd + b'\r'
+
+
+def payload_end(buf, check=False, start=0):
+    # index of the reply payload end (CR or '$' of checksum) or error code
+    end = buf.find(b'\r', start)
+    if end < 0:
+        return NO_CR
+    if not check:
+        return end
+    m = buf.rfind(b'$', start, end)
+    if m < 0:
+        return NO_CHECKSUM
+    if buf[m + 1:end] != checksum(buf, start, m):
+        return BAD_CHECKSUM
+    return m
+
+
+def _payload(buf, check, start):
+    # payload end index or error code, payload may be already stripped from CR and checksum
+    if check:
+        return payload_end(buf, check, start)
+    end = buf.find(b'\r', start)
+    return len(buf) if end < 0 else end
+
+
+def decode_float(buf, check=False, start=0):
+    # scalar reply -> (code, value)
+    if not check and start == 0:
+        # fast path, float() ignores trailing CR
+        try:
+            return OK, float(buf)
+        except ValueError:
+            end = buf.find(b'\r')
+            if end < 0 or end == len(buf) - 1:
+                return BAD_NUMBER, NAN
+    end = _payload(buf, check, start)
+    if end < 0:
+        return end, NAN
+    try:
+        return OK, float(buf[start:end])
+    except ValueError:
+        return BAD_NUMBER, NAN
+
+
+def _split(data, out):
+    # all fields of comma separated reply are decoded at once, float() ignores spaces and CR
+    n = len(out)
+    fields = data.split(b',', n)
+    if len(fields) > n:
+        # more fields than values
+        del fields[n:]
+    if len(fields) != n:
+        return False
+    i = 0
+    try:
+        for s in fields:
+            out[i] = float(s)
+            i += 1
+    except ValueError:
+        return False
+    return True
+
+
+def decode_floats(buf, out, check=False, start=0):
+    # comma separated reply -> preallocated array 'out' filled in place,
+    # returns number of decoded values or error code, not decoded values are NaN
+    n = len(out)
+    # fast path, reply is split as is without copy
+    if not check and start == 0 and _split(buf, out):
+        return n
+    end = _payload(buf, check, start)
+    if end < 0:
+        for i in range(n):
+            out[i] = NAN
+        return end
+    if (check or start or end < len(buf) - 1) and _split(buf[start:end], out):
+        return n
+    # slow path: decode field by field, bad fields are NaN
+    count = 0
+    code = OK
+    pos = start
+    for i in range(n):
+        m = _field.match(buf, pos, end)
+        if m is not None:
+            out[i] = float(m.group(1))
+            count += 1
+            pos = m.end()
+            continue
+        out[i] = NAN
+        if pos >= end:
+            if code == OK:
+                code = TOO_FEW
+            continue
+        code = BAD_NUMBER
+        pos = _skip.match(buf, pos, end).end()
+    return count if code == OK else code
+
+
+def decode_status(buf, out, check=False, start=0):
+    # STT? reply MV(..),PV(..),MC(..),PC(..),SR(hex),FR(hex) -> out[0:4] values, out[4] SR, out[5] FR,
+    # returns 6 or error code, registers are -1 on error
+    end = _payload(buf, check, start)
+    m = _status.match(buf, start, end) if end >= 0 else None
+    if m is None:
+        for i in range(4):
+            out[i] = NAN
+        out[4] = out[5] = -1
+        return end if end < 0 else BAD_NUMBER
+    code = 6
+    for i in range(4):
+        try:
+            out[i] = float(m.group(i + 1))
+        except ValueError:
+            out[i] = NAN
+            code = BAD_NUMBER
+    out[4] = int(m.group(5), 16)
+    out[5] = int(m.group(6), 16)
+    return code
+
+
+SCALAR_QUERIES = (b'PV', b'PC', b'MV', b'MC', b'OVP', b'UVL')
+
+
+def reply_matches(cmd, reply):
+    # rough check that reply may answer cmd, replies carry no request id so late reply
+    # of other command is recognized only if it has different shape
+    cmd = cmd.split(b'$')[0].strip()
+    reply = reply.split(b'$')[0].strip()
+    if reply[:1] in (b'E', b'C') and reply[1:].isdigit():
+        # error code may answer any command
+        return True
+    if not cmd.endswith(b'?'):
+        return reply == b'OK'
+    if reply == b'OK':
+        return False
+    key = cmd[:-1]
+    if key == b'DVC':
+        return reply.count(b',') == 5
+    if key == b'STT':
+        return reply.startswith(b'MV(')
+    if key in SCALAR_QUERIES:
+        try:
+            float(reply)
+        except ValueError:
+            return False
+    return True
+
+
+def flags(sr, fr):
+    # names of set bits of status and fault registers
+    result = []
+    for names, register in ((SR_FLAGS, sr), (FR_FLAGS, fr)):
+        if register < 0:
+            continue
+        for i, name in enumerate(names):
+            if name and int(register) & (1 << i):
+                result.append(name)
+    return result
+
+
+def values(n=6):
+    # preallocated array for decode_floats
+    return array('d', [NAN] * n)
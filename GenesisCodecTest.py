@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Per reply cost of DVC? and scalar reply decoding: split/float versus GenesisCodec
+
+import timeit
+
+import GenesisCodec
+
+N = 200000
+DVC = b'12.500000, 12.498000, 40.000000, 39.912000, 13.750000, 0.000000'
+DVC_CS = DVC + b'$' + GenesisCodec.checksum(DVC) + b'\r'
+SCALAR = b'12.498'
+
+
+def split_floats(reply):
+    # former TDKLambda.read_all decoding
+    sv = reply.split(b',')
+    vals = []
+    for s in sv:
+        try:
+            v = float(s)
+        except:
+            v = float('Nan')
+        vals.append(v)
+    if len(vals) <= 6:
+        vals = [*vals, *[float('Nan')] * 6]
+    return vals[:6]
+
+
+def split_float(reply):
+    try:
+        v = float(reply)
+    except:
+        v = float('Nan')
+    return v
+
+
+def measure(stmt, n=N):
+    return min(timeit.repeat(stmt, number=n, repeat=5)) / n * 1e6
+
+
+if __name__ == "__main__":
+    out = GenesisCodec.values(6)
+    print('DVC?  split/float         %6.3f us' % measure(lambda: split_floats(DVC)))
+    print('DVC?  codec               %6.3f us' % measure(lambda: GenesisCodec.decode_floats(DVC, out)))
+    print('DVC?  codec with checksum %6.3f us' % measure(lambda: GenesisCodec.decode_floats(DVC_CS, out, True)))
+    print('DVC?  split/float, error  %6.3f us' % measure(lambda: split_floats(b'12.5, E01')))
+    print('DVC?  codec, error        %6.3f us' % measure(lambda: GenesisCodec.decode_floats(b'12.5, E01', out)))
+    print('PV?   float               %6.3f us' % measure(lambda: split_float(SCALAR)))
+    print('PV?   codec               %6.3f us' % measure(lambda: GenesisCodec.decode_float(SCALAR)))
+    print('PV?   float, error        %6.3f us' % measure(lambda: split_float(b'C01')))
+    print('PV?   codec, error        %6.3f us' % measure(lambda: GenesisCodec.decode_float(b'C01')))
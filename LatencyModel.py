@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+
+
+class LatencyModel:
+    # Response time histograms by command class. Reading deadline is derived from high
+    # percentile of observed times, so a silent device is detected in tens of ms instead
+    # of fixed timeout. Every miss doubles deadline of the class until next response.
+    EDGES = [0.0005 * 1.2 ** i for i in range(46)]     # 0.5 ms .. 2.0 s bucket upper edges
+    MIN_SAMPLES = 20
+    MAX_SAMPLES = 1000      # counts are halved above it to follow drift of latency
+    PERCENTILE = 0.99
+    MARGIN = 2.0
+    SLACK = 0.01
+    MAX_MISSES = 8
+
+    def __init__(self, min_timeout=0.02, max_timeout=0.5):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.counts = {}        # class -> bucket counts
+        self.totals = {}
+        self.misses = {}
+
+    @staticmethod
+    def command_class(cmd):
+        # 'ADR', query mnemonic like 'DVC?', or 'SET' for setting commands
+        cmd = cmd.strip().split(b'$')[0]
+        if cmd.startswith(b'ADR'):
+            return b'ADR'
+        if cmd.endswith(b'?'):
+            return cmd.split(b' ')[0]
+        return b'SET'
+
+    def record(self, cmd, dt):
+        cls = self.command_class(cmd)
+        counts = self.counts.get(cls)
+        if counts is None:
+            counts = [0] * (len(self.EDGES) + 1)
+            self.counts[cls] = counts
+            self.totals[cls] = 0
+        counts[bisect_left(self.EDGES, dt)] += 1
+        self.totals[cls] += 1
+        self.misses[cls] = 0
+        if self.totals[cls] > self.MAX_SAMPLES:
+            for i in range(len(counts)):
+                counts[i] //= 2
+            self.totals[cls] = sum(counts)
+
+    def missed(self, cmd):
+        cls = self.command_class(cmd)
+        self.misses[cls] = min(self.misses.get(cls, 0) + 1, self.MAX_MISSES)
+
+    def percentile(self, cmd, p=PERCENTILE):
+        cls = self.command_class(cmd)
+        total = self.totals.get(cls, 0)
+        if total < self.MIN_SAMPLES:
+            return None
+        n = p * total
+        s = 0
+        counts = self.counts[cls]
+        for i, c in enumerate(counts):
+            s += c
+            if s >= n:
+                return self.EDGES[i] if i < len(self.EDGES) else self.max_timeout
+        return self.max_timeout
+
+    def learned_timeout(self, cmd):
+        # deadline derived from observed times, None if the class (any class for ADR) is not learned
+        p = self.percentile(cmd)
+        if p is None and self.command_class(cmd) == b'ADR':
+            # short OK reply, the slowest learned class is used until ADR is learned
+            learned = [self.percentile(c) for c in self.totals if self.totals[c] >= self.MIN_SAMPLES]
+            p = max(learned, default=None)
+        if p is None:
+            return None
+        t = (p * self.MARGIN + self.SLACK) * 2 ** self.misses.get(self.command_class(cmd), 0)
+        return min(max(t, self.min_timeout), self.max_timeout)
+
+    def timeout(self, cmd):
+        t = self.learned_timeout(cmd)
+        return self.max_timeout if t is None else t
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from contextlib import nullcontext
+from threading import Lock, Thread, Event
+
+
+class Poller:
+    # Background reading of the devices of one port. Devices are polled round-robin, every one
+    # not more often than it asks. Device provides poll_due(now) - seconds until next reading,
+    # None if polling is disabled, and poll() - reading itself.
+    MAX_SLEEP = 0.1
+    # context of poller thread, for example to push Tango events from it
+    THREAD_CONTEXT = None
+    pollers = {}
+    lock = Lock()
+
+    def __init__(self, port):
+        self.logger = logging.getLogger('Poller')
+        self.port = port
+        self.devices = []
+        self.index = 0
+        self.polls = 0
+        self.event = Event()
+        self.thread = Thread(target=self.run, name='Poller %s' % port, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def get(port):
+        with Poller.lock:
+            poller = Poller.pollers.get(port)
+            if poller is None:
+                poller = Poller(port)
+                Poller.pollers[port] = poller
+            return poller
+
+    def add(self, device):
+        if device not in self.devices:
+            self.devices.append(device)
+        self.event.set()
+
+    def remove(self, device):
+        try:
+            self.devices.remove(device)
+        except ValueError:
+            pass
+
+    def wake(self):
+        # poll_due of devices has changed
+        self.event.set()
+
+    def next_device(self):
+        # the first due device after the last polled one, or None and time to sleep
+        now = time.time()
+        devices = list(self.devices)
+        n = len(devices)
+        delay = self.MAX_SLEEP
+        for i in range(n):
+            d = devices[(self.index + i) % n]
+            due = d.poll_due(now)
+            if due is None:
+                continue
+            if due <= 0.0:
+                self.index = (self.index + i + 1) % n
+                return d, 0.0
+            delay = min(delay, due)
+        return None, delay
+
+    def run(self):
+        context = nullcontext() if self.THREAD_CONTEXT is None else self.THREAD_CONTEXT()
+        with context:
+            self.loop()
+
+    def loop(self):
+        while True:
+            try:
+                device, delay = self.next_device()
+            except:
+                self.logger.debug('Poller %s error', self.port, exc_info=True)
+                device, delay = None, self.MAX_SLEEP
+            if device is None:
+                self.event.wait(delay)
+                self.event.clear()
+                continue
+            try:
+                device.poll()
+                self.polls += 1
+            except:
+                self.logger.debug('Poll %s error', device, exc_info=True)
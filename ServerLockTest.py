@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Reading throughput of TDKLambda_Server access pattern: one module wide lock versus
+# one lock per bus, two emulated supplies per FAKE port, one client thread per supply
+
+import logging
+import time
+from threading import Lock, Thread
+
+from TDKLambda import TDKLambda
+
+DURATION = 2.0
+DEVICES_PER_PORT = 2
+
+
+def client(device, lock, counts, index, t_end):
+    n = 0
+    while time.time() < t_end:
+        with lock:
+            device.read_status()
+        n += 1
+    counts[index] = n
+
+
+def measure(devices, locks):
+    counts = [0] * len(devices)
+    t_end = time.time() + DURATION
+    threads = [Thread(target=client, args=(d, locks[d.port], counts, i, t_end)) for i, d in enumerate(devices)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / DURATION
+
+
+if __name__ == "__main__":
+    TDKLambda.LOG_LEVEL = logging.WARNING
+    print('reads/s by number of ports')
+    print('ports  global lock  bus locks')
+    for ports in (1, 2, 4, 8):
+        names = ['FAKELOCK%d_%d' % (ports, i) for i in range(ports)]
+        devices = [TDKLambda(name, a) for name in names for a in range(1, DEVICES_PER_PORT + 1)]
+        lock = Lock()
+        r1 = measure(devices, {name: lock for name in names})
+        r2 = measure(devices, {name: Lock() for name in names})
+        print('%5d  %11.1f  %9.1f' % (ports, r1, r2))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Latency of TDKLambda over MoxaTCPComPort measured against local TCP emulator
+
+import logging
+import socket
+import sys
+import time
+from threading import Thread
+
+from EmulatedLambda import FakeComPort
+from TDKLambda import TDKLambda, ComPort
+
+N = 500
+
+
+class TCPEmulator:
+    # NPort emulator: TCP server passing CR terminated frames to FakeComPort
+    def __init__(self, port=0, silent=()):
+        self.silent = silent
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.thread = Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            conn, _ = self.server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            fake = FakeComPort('FAKE')
+            fake.RESPONSE_DELAY = 0.0
+            buf = b''
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                buf += data
+                while b'\r' in buf:
+                    n = buf.find(b'\r') + 1
+                    cmd, buf = buf[:n], buf[n:]
+                    fake.write(cmd)
+                    if fake.last_address in self.silent:
+                        fake.last_write = b''
+                        continue
+                    conn.sendall(fake.read())
+            conn.close()
+
+
+def stats(times):
+    times = sorted(times)
+    n = len(times)
+    return 'mean %6.3f ms  p50 %6.3f ms  p99 %6.3f ms' % \
+           (sum(times) / n * 1000.0, times[n // 2] * 1000.0, times[int(n * 0.99)] * 1000.0)
+
+
+def measure(devices, n=N):
+    times = []
+    for i in range(n):
+        d = devices[i % len(devices)]
+        t0 = time.perf_counter()
+        d.read_all()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+if __name__ == "__main__":
+    TDKLambda.LOG_LEVEL = logging.WARNING
+    emulator = TCPEmulator(silent=(9,))
+    port = '127.0.0.1:%d' % emulator.port
+    pd1 = TDKLambda(port, 6)
+    pd2 = TDKLambda(port, 7)
+    com = ComPort(port)
+    com.logger.setLevel(logging.WARNING)
+    print('DVC? one address              ', stats(measure([pd1])))
+    com._device.coalesce = False
+    print('DVC? two addresses, ADR apart ', stats(measure([pd1, pd2])))
+    com._device.coalesce = True
+    print('DVC? two addresses, coalesced ', stats(measure([pd1, pd2])))
+    # silent device on the same NPort must not hang the port
+    pd9 = TDKLambda(port, 9)
+    pd9.unsuspend()
+    t0 = time.perf_counter()
+    pd9.read_all()
+    print('Silent address %d ms, port lock released: %s' % ((time.perf_counter() - t0) * 1000.0,
+                                                           not com.lock.locked()), file=sys.stderr)
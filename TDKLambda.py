@@ -1,18 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import errno
 import logging
+import os
+import random
+import select
 import socket
 import time
-from threading import Lock, Thread
+from threading import Lock, Thread, get_ident
 from collections import deque
-import asyncio
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 import serial
 from serial import *
 
 from EmulatedLambda import FakeComPort
 from Counter import Counter
+from FrameTracker import FrameTracker
+from LatencyModel import LatencyModel
+from CircuitBreaker import CircuitBreaker
+import GenesisCodec
+from ComReactor import ComReactor, Transaction
 from TDKLambdaExceptions import *
 from Async.AsyncSerial import Timeout
 
@@ -27,7 +36,7 @@ class Command:
         self.time_end = 0.0
         self.callback = callback
         self.state = 0          # 0 - created; 1 - queued; 2 - executing; 3 - completed
-        self.task = None
+        self.future = Future()
         self.result = b''
 
     @property
@@ -44,7 +53,14 @@ class Command:
 
 
 class MoxaTCPComPort:
-    def __init__(self, host, port=4001, **kwargs):
+    CONNECT_TIMEOUT = 1.0
+    WRITE_TIMEOUT = 0.5
+    READ_CHUNK = 4096
+    MIN_BACKOFF = 0.1
+    MAX_BACKOFF = 5.0
+    KEEPALIVE = {'TCP_KEEPIDLE': 10, 'TCP_KEEPINTVL': 5, 'TCP_KEEPCNT': 3}
+
+    def __init__(self, host, port=4001, timeout=0.0, write_timeout=WRITE_TIMEOUT, coalesce=True, **kwargs):
         if ':' in host:
             n = host.find(':')
             self.host = host[:n].strip()
@@ -55,28 +71,199 @@ class MoxaTCPComPort:
         else:
             self.host = host
             self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
+        # default deadlines for read and write calls
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        # send ADR and following command in one write
+        self.coalesce = coalesce
+        self.socket = None
+        self.connecting = None      # socket of connection in progress
+        self.connect_deadline = 0.0
+        self.closed = False
+        self.backoff = 0.0
+        self.next_connect = 0.0
+        self.connect(self.CONNECT_TIMEOUT)
+
+    def create_socket(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for name, value in self.KEEPALIVE.items():
+                if hasattr(socket, name):
+                    s.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+        except:
+            s.close()
+            raise
+        return s, (self.host, self.port)
+
+    def connect(self, timeout=None):
+        # starts non-blocking connection, it is completed by reconnect() calls, or waited for
+        # at most timeout if given
+        self.disconnect()
+        s = None
+        try:
+            s, address = self.create_socket()
+            s.setblocking(False)
+            error = s.connect_ex(address)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, errno.EALREADY):
+                raise OSError(error, os.strerror(error))
+        except:
+            if s is not None:
+                s.close()
+            self.failed()
+            raise
+        self.connecting = s
+        self.connect_deadline = time.time() + self.CONNECT_TIMEOUT
+        if timeout is None:
+            return self.connected(0.0)
+        if not self.connected(timeout):
+            raise OSError(errno.ETIMEDOUT, 'Connection to %s:%s failed' % (self.host, self.port))
+        return True
+
+    def connected(self, timeout=0.0):
+        # True if connection in progress has been established
+        s = self.connecting
+        _, w, _ = select.select([], [s], [], timeout)
+        if w:
+            error = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        elif time.time() >= self.connect_deadline:
+            error = errno.ETIMEDOUT
+        else:
+            return False
+        self.connecting = None
+        if error:
+            s.close()
+            self.failed()
+            return False
+        self.socket = s
+        self.backoff = 0.0
+        self.next_connect = 0.0
+        return True
+
+    def failed(self):
+        # bounded exponential backoff with jitter for the next attempt
+        self.backoff = min(max(2.0 * self.backoff, self.MIN_BACKOFF), self.MAX_BACKOFF)
+        self.next_connect = time.time() + self.backoff * (0.5 + 0.5 * random.random())
+
+    def disconnect(self):
+        for s in (self.socket, self.connecting):
+            if s is not None:
+                try:
+                    s.close()
+                except:
+                    pass
+        self.socket = None
+        self.connecting = None
+
+    def reconnect(self):
+        # returns True if connected, does not block and does not retry before backoff expires
+        if self.socket is not None:
+            return True
+        if self.connecting is not None:
+            return self.connected(0.0)
+        if self.closed or time.time() < self.next_connect:
+            return False
+        try:
+            return self.connect()
+        except:
+            return False
 
     def close(self):
-        self.socket.close()
+        self.closed = True
+        self.disconnect()
         return True
 
-    def write(self, cmd):
-        self.socket.send(cmd)
+    def write(self, cmd, timeout=None):
+        if timeout is None:
+            timeout = self.write_timeout
+        t0 = time.perf_counter()
+        view = memoryview(cmd)
+        sent = 0
+        while sent < len(view):
+            if not self.reconnect():
+                break
+            try:
+                sent += self.socket.send(view[sent:])
+                continue
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.disconnect()
+                break
+            remaining = timeout - (time.perf_counter() - t0)
+            if remaining <= 0.0:
+                break
+            select.select([], [self.socket], [], remaining)
+        return sent
+
+    def read(self, n=1, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        if not self.wait(timeout):
+            return b''
+        try:
+            data = self.socket.recv(n)
+        except BlockingIOError:
+            return b''
+        except OSError:
+            self.disconnect()
+            return b''
+        if not data:
+            # connection closed by NPort
+            self.disconnect()
+        return data
+
+    def wait(self, timeout=None):
+        if not self.reconnect():
+            if timeout is None:
+                timeout = max(self.next_connect - time.time(), self.MIN_BACKOFF)
+            time.sleep(timeout)
+            return False
+        r, _, _ = select.select([self.socket], [], [], timeout)
+        return len(r) > 0
 
-    def read(self, n):
-        return self.socket.recv(n)
+    def fileno(self):
+        if self.socket is None:
+            raise OSError('Socket is not connected')
+        return self.socket.fileno()
 
     def isOpen(self):
-        return True
+        return not self.closed
 
     def reset_input_buffer(self):
+        # discard all received but unread data
+        while self.read(self.READ_CHUNK, 0.0):
+            pass
         return True
 
 
+def ipc_address(address):
+    # 'host:port' is TCP address, anything else is Unix socket path
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class IPCComPort(MoxaTCPComPort):
+    # port shared by BusDaemon process, name is ipc://<socket path> or ipc://<host>:<port>
+    def __init__(self, address, **kwargs):
+        self.family, self.address = ipc_address(address)
+        super().__init__(address, **kwargs)
+
+    def create_socket(self):
+        if self.family != socket.AF_UNIX:
+            return super().create_socket()
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), self.address
+
+
 class ComPort:
     _devices = {}
+    READ_CHUNK = 4096
+    GLOBAL_COMMANDS = (b'PV', b'PC', b'OUT', b'RST')
+    GLOBAL_DELAY = 0.2      # devices do not respond after global command
+    VERIFY_QUERY = {b'PV': b'PV?', b'PC': b'PC?', b'OUT': b'OUT?', b'RST': b'OUT?'}
 
     class UninitializedDevice:
         def __init__(self, port, *args, **kwargs):
@@ -114,6 +301,23 @@ class ComPort:
         self.lock = Lock()
         self._ex = None
         self.time = 0.0
+        # receive buffer, filled by chunks and consumed by frames
+        self.buffer = bytearray()
+        # requests waiting for responses and counters of late and stale frames
+        self.tracker = FrameTracker()
+        # transactions submitted to reactor and the one in progress
+        self.queue = deque()
+        self.active = None
+        # transactions for selected address taken ahead of the queue head, and counters
+        self.batch = 0
+        self.schedule = {'adr_switches': 0, 'adr_avoided': 0, 'coalesced': 0, 'combined': 0}
+        # Genesis global commands support, None - unknown
+        self.global_commands = None
+        # time of last response by address, updated by every completed transaction
+        self.seen = {}
+        # port reopening with backoff, one recovery probe reopens port for all devices
+        self.breaker = CircuitBreaker(port, base=1.0)
+        self.reopen_lock = Lock()
 
         logger = logging.getLogger(str(self))
         logger.propagate = False
@@ -132,17 +336,24 @@ class ComPort:
         self.init()
 
     def init(self):
-        if self.lock.locked():
+        # lock of active transaction is released by the reactor when it is completed
+        if self.lock.locked() and self.active is None:
             self.logger.warning('Init on locked port')
             self.lock.release()
+        self.buffer.clear()
+        self.tracker.clear()
         # initialize real device
         if self.port.startswith('FAKE'):
             self._device = FakeComPort(self.port, *self.args, **self.kwargs)
             result = True
+        elif self.port.startswith('ipc://'):
+            try:
+                self._device = IPCComPort(self.port[6:])
+                result = True
+            except Exception as ex:
+                self._ex = [ex]
+                result = False
         else:
-            if time.time() - self.time < 3.0:
-                self.logger.warning('Frequent initialization declined')
-                return False
             try:
                 self._device = serial.Serial(self.port, *self.args, timeout=0.0, write_timeout=0.0, **self.kwargs)
                 result = True
@@ -164,19 +375,267 @@ class ComPort:
         self.logger.debug('Port %s has been initialized', self.port)
         return result
 
-    def read(self, *args, **kwargs):
-        if self.ready:
-            return self._device.read(*args, **kwargs)
-        else:
-            return b''
+    def fill(self):
+        # read all available bytes by one call and append them to receive buffer
+        if not self.ready:
+            return 0
+        n = getattr(self._device, 'in_waiting', self.READ_CHUNK)
+        if n <= 0:
+            return 0
+        data = self._device.read(n)
+        if data:
+            self.buffer += data
+        return len(data)
+
+    def wait(self, timeout=None):
+        # block until input is available or timeout expires, without polling
+        if not self.ready:
+            if timeout is not None:
+                time.sleep(timeout)
+            return False
+        device = self._device
+        if hasattr(device, 'wait'):
+            return device.wait(timeout)
+        try:
+            fd = device.fileno()
+        except:
+            fd = None
+        if fd is not None:
+            r, _, _ = select.select([fd], [], [], timeout)
+            return len(r) > 0
+        # serial port without selectable handle (Windows), use blocking read with timeout
+        device.timeout = timeout
+        try:
+            data = device.read(1)
+        finally:
+            device.timeout = 0.0
+        if data:
+            self.buffer += data
+        return len(data) > 0
+
+    def fileno(self):
+        # selectable handle of the port or None
+        if not self.ready:
+            return None
+        try:
+            return self._device.fileno()
+        except:
+            return None
 
-    def write(self, *args, **kwargs):
-        if self.ready:
-            return self._device.write(*args, **kwargs)
-        else:
+    def drop_srq(self):
+        # service requests '!nn' are not responses, they are passed to tracker
+        while self.buffer.startswith(b'!'):
+            n = self.buffer.find(CR)
+            if n < 0:
+                return
+            self.tracker.unread(bytes(self.buffer[:n]))
+            del self.buffer[:n + 1]
+
+    def check_srq(self):
+        # set of addresses of devices which sent service request, port is read only if it is idle,
+        # device removes its address when request is handled
+        if self.ready and self.active is None and self.lock.acquire(blocking=False):
+            try:
+                if self.wait(0.0):
+                    self.fill()
+                self.drop_srq()
+                if not self.tracker.requests:
+                    self.tracker.discard(self.buffer)
+            finally:
+                self.lock.release()
+        return self.tracker.srq
+
+    def take(self, terminator=CR):
+        # remove and return complete frame from receive buffer without waiting, None if there is no frame
+        self.drop_srq()
+        n = self.buffer.find(terminator)
+        if n < 0:
+            return None
+        n += len(terminator)
+        result = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        self.tracker.answered()
+        return result
+
+    def submit(self, cmd, addr=-1, adr=b'', timeout=0.5, reply=True):
+        # queue prepared command to the reactor thread, returns Future with response frame,
+        # response is b'' on timeout or address selection error
+        return ComReactor.get().submit(self, Transaction(cmd, addr, adr, timeout, reply)).future
+
+    def device(self, addr):
+        # TDKLambda device of the port with given address, None if address is unknown
+        for d in TDKLambda.devices:
+            if d.com is self and d.addr == addr:
+                return d
+        return None
+
+    def submit_all(self, cmd, addrs, check=False, timeout=0.5):
+        # Queue command to all addresses at once, returns list of transactions in addrs order.
+        # Known devices use their learned deadlines, suspended ones are skipped (None in the list),
+        # timeout is used for unknown addresses.
+        frame = GenesisCodec.frame(cmd, check)
+        reactor = ComReactor.get()
+        result = []
+        for a in addrs:
+            d = self.device(a)
+            if d is None:
+                t = timeout
+            elif d.is_suspended():
+                result.append(None)
+                continue
+            else:
+                t = d.latency.timeout(cmd)
+            result.append(reactor.submit(self, Transaction(frame, a, GenesisCodec.frame(b'ADR %d' % a, check), t)))
+        return result
+
+    def wait_timeout(self, timeout):
+        # the reactor completes transaction by its deadlines, waiting is bounded in case it fails,
+        # transactions queued before it may time out too
+        return (len(self.queue) + 2) * (2.0 * timeout + ComReactor.MAX_LATE_GUARD)
+
+    def results(self, transactions):
+        # responses of transactions in given order, b'' for skipped (None) or not completed ones
+        timeout = max([tr.timeout for tr in transactions if tr is not None], default=0.0)
+        deadline = time.time() + self.wait_timeout(timeout)
+        result = []
+        for tr in transactions:
+            try:
+                result.append(b'' if tr is None else tr.future.result(max(deadline - time.time(), 0.0)))
+            except FutureTimeoutError:
+                result.append(b'')
+        return result
+
+    def alive(self, max_age, exclude=-1):
+        # True if any device except excluded one has responded within max_age
+        t = time.time() - max_age
+        return any(a != exclude and v > t for a, v in list(self.seen.items()))
+
+    def read_many(self, addrs, check=False, timeout=0.5):
+        # DVC? of all addresses by one call, returns N x 6 values, completion times and validity
+        # rows in addrs order
+        return ComPort.read_fleet({self.port: addrs}, check, timeout)[1:]
+
+    @staticmethod
+    def read_fleet(addresses=None, check=False, timeout=0.5):
+        # DVC? snapshot of all ports, {port name: addresses}, all TDKLambda devices by default.
+        # Ports are serviced in parallel by the reactor, queries of every port are executed
+        # in address order. Returns ((port, address) list, N x 6 values, times, validity).
+        import numpy
+        if addresses is None:
+            addresses = {}
+            for d in TDKLambda.devices:
+                addresses.setdefault(d.port, []).append(d.addr)
+        keys = []
+        submitted = []
+        for name, addrs in addresses.items():
+            port = ComPort._devices.get(name)
+            keys.extend((name, a) for a in addrs)
+            if port is None or not port.ready:
+                submitted.append((None, [None] * len(addrs)))
+                continue
+            # rows are in given order, queries are queued in address order
+            order = sorted(range(len(addrs)), key=lambda i: addrs[i])
+            row = [None] * len(addrs)
+            for i, tr in zip(order, port.submit_all(b'DVC?', [addrs[i] for i in order], check, timeout)):
+                row[i] = tr
+            submitted.append((port, row))
+        n = len(keys)
+        values = numpy.full((n, 6), numpy.nan)
+        times = numpy.zeros(n)
+        valid = numpy.zeros(n, dtype=bool)
+        k = 0
+        for port, row in submitted:
+            responses = port.results(row) if port is not None else [b''] * len(row)
+            for tr, response in zip(row, responses):
+                if tr is not None:
+                    valid[k] = GenesisCodec.decode_floats(response, values[k], check) == 6
+                    times[k] = tr.time_end
+                k += 1
+        return keys, values, times, valid
+
+    def write_all(self, cmd, value, addrs, check=False, timeout=0.5, verify=True):
+        # Set the same value for all addresses by one Genesis global command (GPV, GPC, GOUT, GRST),
+        # or by address sorted sequence of commands. Global command acts on every supply of the bus,
+        # it is used only if addrs cover all devices of the port and it is supported.
+        # Result is checked by one pass of queries. Returns {address: success}.
+        cmd = cmd.upper().strip()
+        if isinstance(value, bool):
+            value = b'ON' if value else b'OFF'
+        elif value is not None and not isinstance(value, bytes):
+            value = str.encode(str(value))[:10]
+        arg = cmd if value is None else cmd + b' ' + value
+        addrs = sorted(set(addrs))
+        result = {}
+        pending = addrs
+        # programmed state cache of the devices is not valid
+        port_addrs = set()
+        for d in TDKLambda.devices:
+            if d.com is self:
+                port_addrs.add(d.addr)
+                if d.addr in addrs:
+                    d.state.clear()
+        whole_bus = port_addrs.issubset(addrs)
+        if whole_bus and self.global_commands is not False and cmd in self.GLOBAL_COMMANDS:
+            future = self.submit(GenesisCodec.frame(b'G' + arg, check), timeout=self.GLOBAL_DELAY, reply=False)
+            try:
+                future.result(self.wait_timeout(self.GLOBAL_DELAY))
+            except FutureTimeoutError:
+                pass
+            if not verify and self.global_commands:
+                return {a: True for a in addrs}
+            # global command support is unknown until the first verification
+            result = self.verify(cmd, value, addrs, check, timeout)
+            pending = [a for a in addrs if not result[a]]
+            if not pending:
+                self.global_commands = True
+                return result
+            if len(pending) == len(addrs) and self.global_commands is None:
+                self.logger.info('Global commands are not supported')
+                self.global_commands = False
+        # all commands are queued at once, reactor executes them in address order
+        for a, response in zip(pending, self.results(self.submit_all(arg, pending, check, timeout))):
+            result[a] = response.startswith(b'OK')
+        if verify:
+            result.update(self.verify(cmd, value, [a for a in pending if result[a]], check, timeout))
+        return result
+
+    def verify(self, cmd, value, addrs, check=False, timeout=0.5):
+        # one pass of queries of all addresses, returns {address: value is set}
+        query = self.VERIFY_QUERY.get(cmd)
+        if query is None:
+            return {a: True for a in addrs}
+        result = {}
+        for a, response in zip(addrs, self.results(self.submit_all(query, addrs, check, timeout))):
+            end = GenesisCodec.payload_end(response, check)
+            if end < 0:
+                result[a] = False
+            elif cmd == b'OUT' or cmd == b'RST':
+                expected = b'OFF' if cmd == b'RST' or value in (b'OFF', b'0') else b'ON'
+                result[a] = response[:end].strip().upper() == expected
+            else:
+                code, v = GenesisCodec.decode_float(response, check)
+                x = float(value)
+                result[a] = code == 0 and abs(v - x) <= 0.01 + 1e-3 * abs(x)
+        return result
+
+    def write(self, data, *args, **kwargs):
+        if not self.ready:
             return 0
+        # frames which were not read by their requests are discarded instead of port flushing,
+        # port is checked for input only if late responses are possible
+        if self.tracker.expire() and self.wait(0.0):
+            self.fill()
+        self.tracker.discard(self.buffer)
+        self.tracker.written(data, self.current_addr)
+        return self._device.write(data, *args, **kwargs)
+
+    @property
+    def stats(self):
+        return self.tracker.stats
 
     def reset_input_buffer(self):
+        self.buffer.clear()
+        self.tracker.clear()
         if self.ready:
             try:
                 self._device.reset_input_buffer()
@@ -196,6 +655,10 @@ class ComPort:
     def ready(self):
         return self._device.isOpen()
 
+    @property
+    def coalesce(self):
+        return getattr(self._device, 'coalesce', False)
+
 
 def ms(t0):
     return (time.perf_counter() - t0) * 1000.0
@@ -203,12 +666,20 @@ def ms(t0):
 
 class TDKLambda:
     LOG_LEVEL = logging.DEBUG
-    SUSPEND_TIME = 5.0
+    # responses of the port devices during this time prove port is working
+    LIVENESS_TIME = 5.0
+    # breaker backoff, doubled by every failed recovery probe
+    BACKOFF = 0.5
+    MAX_BACKOFF = 30.0
+    # ADR deadline of recovery probe if no device of the port has learned one
+    PROBE_TIMEOUT = 0.1
+    STATE_KEYS = (b'PV', b'PC', b'OUT')
+    HISTORY = 100
     devices = []
-    loop = None
-    thread = None
+    # submitted and not completed commands of all devices, and last completed ones
     commands = deque()
-    completed_commands = deque()
+    completed_commands = deque(maxlen=HISTORY)
+    commands_lock = Lock()
 
     def __init__(self, port, addr, checksum=False, baud_rate=9600, logger=None, **kwargs):
         # check device address
@@ -225,17 +696,28 @@ class TDKLambda:
         self.command = b''
         self.response = b''
         self.time = time.time()
-        self.suspend_to = time.time()
-        self.suspend_flag = False
+        # failed device is rejected at once and recovered by background probe
+        self.breaker = CircuitBreaker('%s:%d' % (self.port, addr), self.BACKOFF, self.MAX_BACKOFF)
         # timeouts
         self.read_timeout = 0.5
         self.min_read_time = self.read_timeout
+        # reading deadlines by command class
+        self.latency = LatencyModel(max_timeout=self.read_timeout)
         # default com port, id, and serial number
         self.com = None
         self.id = 'Unknown Device'
         self.sn = 0
         self.max_voltage = float('inf')
         self.max_current = float('inf')
+        # last DVC? values
+        self.values = GenesisCodec.values(6)
+        # last STT? values MV, PV, MC, PC, SR, FR
+        self.status = GenesisCodec.values(6)
+        self.srq = False
+        # programmed state confirmed by device {b'PV': float, b'PC': float, b'OUT': bool},
+        # writes of the same values are skipped
+        self.state = {}
+        self.write_stats = {'written': 0, 'skipped': 0}
         # configure logger
         self.configure_logger()
         # check if port and address are in use
@@ -253,49 +735,98 @@ class TDKLambda:
         if self in TDKLambda.devices:
             TDKLambda.devices.remove(self)
 
-    @staticmethod
-    async def dispatcher():
-        while True:
-            for cmd in TDKLambda.commands:
-                if cmd.queued():
-                    # check if it is repeated command
-                    flag = False
-                    cmd1 = cmd.command[:4]
-                    for cmd2 in TDKLambda.commands:
-                        if cmd2.state != 2:
-                            continue
-                        if cmd2.command[:4] == cmd1:
-                            flag = True
-                            break
-                    if flag:
-                        TDKLambda.commands.remove(cmd)
-                    else:
-                        cmd.task = asyncio.create_task(cmd.device._send_command(cmd.command))
-                        cmd.state = 2
-                elif cmd.task.done():
-                    cmd.state = 3
-                    cmd.exception = cmd.task.exception()
-                    if cmd.exception is None:
-                        cmd.result = cmd.task.result()
-                    else:
-                        cmd.result = b''
-                    TDKLambda.commands.remove(cmd)
-                    TDKLambda.completed_commands.append(cmd)
-            await asyncio.sleep(0)
+    def submit(self, cmd, callback=None):
+        # Queue command to the reactor thread servicing all ports. Returns Future with response
+        # without CR and checksum, b'' if device does not respond. Identical pending queries
+        # of the device share one Future. callback(Command) is called in the reactor thread
+        # and should not block.
+        cmd = self.prepare_command(cmd)
+        if self.setting(cmd):
+            # programmed state is unknown until the setting is confirmed
+            self.invalidate(cmd)
+        with TDKLambda.commands_lock:
+            if b'?' in cmd:
+                # not shared with query submitted before a setting command
+                for c in reversed(TDKLambda.commands):
+                    if c.device is not self:
+                        continue
+                    if c.command == cmd:
+                        if callback is not None:
+                            c.future.add_done_callback(lambda f: callback(c))
+                        return c.future
+                    if b'?' not in c.command:
+                        break
+            command = Command(cmd, self, callback)
+            TDKLambda.commands.append(command)
+        if self.is_suspended():
+            self.logger.debug('Command %s to suspended device ignored', cmd)
+            self.complete(command)
+            return command.future
+        if self.auto_addr:
+            tr = Transaction(cmd, self.addr, self.prepare_command(b'ADR %d' % self.addr), self.latency.timeout(cmd))
+        else:
+            tr = Transaction(cmd, -1, b'', self.latency.timeout(cmd))
+        command.state = 1
+        tr = ComReactor.get().submit(self.com, tr)
+        tr.future.add_done_callback(lambda f: self.completed(command, tr))
+        return command.future
 
-    @staticmethod
-    def start_loop(self):
-        if TDKLambda.loop is not None:
+    def completed(self, command, tr):
+        try:
+            frame = tr.future.result()
+        except:
+            self.logger.debug('Command %s error', command.command, exc_info=True)
+            frame = b''
+        end = GenesisCodec.payload_end(frame, self.check)
+        if end < 0:
+            self.latency.missed(command.command)
+            if frame:
+                self.logger.error('%s in response %s', GenesisCodec.MESSAGES[end], frame)
+            if self.setting(command.command):
+                self.invalidate(command.command)
+            self.complete(command)
             return
-        TDKLambda.loop = asyncio.get_running_loop()
-        asyncio.run(TDKLambda.dispatcher())
+        self.latency.record(command.command, tr.elapsed)
+        if tr.elapsed < self.min_read_time:
+            self.min_read_time = tr.elapsed
+        if self.setting(command.command):
+            # value of executed setting, it may be newer than the command's one,
+            # error response, RST and other settings leave the state unknown
+            setting = (tr.superseded_by or tr).command.split(b'$')[0].strip().split(b' ', 1)
+            if frame.startswith(b'OK') and setting[0] in self.STATE_KEYS and len(setting) > 1:
+                self.confirm(setting[0], self.state_value(setting[0], setting[1]))
+            else:
+                self.invalidate(command.command)
+        self.complete(command, frame[:end])
 
     @staticmethod
-    def init_thread(self):
-        if TDKLambda.thread is not None:
-            return
-        TDKLambda.thread = Thread(target=TDKLambda.start_loop, args=())
-        TDKLambda.thread.start()
+    def setting(cmd):
+        return b'?' not in cmd and not cmd.startswith(b'ADR')
+
+    def invalidate(self, cmd):
+        # forget programmed value changed by setting command, all values for unknown command
+        key = cmd.split(b'$')[0].split(b' ')[0].strip()
+        if key in self.STATE_KEYS:
+            self.state.pop(key, None)
+        else:
+            self.state.clear()
+
+    def complete(self, command, result=b''):
+        command.result = result
+        command.time_end = time.time()
+        command.state = 3
+        with TDKLambda.commands_lock:
+            try:
+                TDKLambda.commands.remove(command)
+            except ValueError:
+                pass
+            TDKLambda.completed_commands.append(command)
+        if command.callback is not None:
+            try:
+                command.callback(command)
+            except:
+                self.logger.debug('Callback error', exc_info=True)
+        command.future.set_result(result)
 
     def configure_logger(self, level=None):
         logger = logging.getLogger(str(self))
@@ -323,7 +854,11 @@ class TDKLambda:
         return self.com
 
     def init(self):
-        self.unsuspend()
+        # programmed state of reset or rebooted device is unknown
+        self.state.clear()
+        if not self.probing():
+            # explicit initialization is not rejected by open breaker
+            self.unsuspend()
         if not self.com.ready:
             self.suspend()
             return
@@ -334,10 +869,13 @@ class TDKLambda:
             msg = 'TDKLambda: device was not initialized properly'
             self.logger.info(msg)
             return
-        # read device serial number
+        # read device serial number and type, other device on the address is logged
+        sn = self.sn
+        device_id = self.id
         self.sn = self.read_serial_number()
-        # read device type
         self.id = self.read_device_id()
+        if sn and (sn, device_id) != (self.sn, self.id):
+            self.logger.info('Device changed: %s SN:%s -> %s SN:%s', device_id, sn, self.id, self.sn)
         if self.id.find('LAMBDA') >= 0:
             # determine max current and voltage from model name
             n1 = self.id.find('GEN')
@@ -353,6 +891,7 @@ class TDKLambda:
             msg = 'TDKLambda: device was not initialized properly'
             self.logger.info(msg)
             return
+        self.unsuspend()
         msg = 'TDKLambda: %s SN:%s has been initialized' % (self.id, self.sn)
         self.logger.debug(msg)
 
@@ -401,94 +940,49 @@ class TDKLambda:
         result = str.encode(hex(s)[-2:].upper())
         return result
 
-    def suspend(self, duration=SUSPEND_TIME):
-        self.suspend_to = time.time() + duration
-        self.suspend_flag = True
+    def suspend(self, duration=None):
+        # open breaker, duration is backoff of consecutive failures if not given
+        if self.breaker.state == CircuitBreaker.OPEN and duration is None:
+            return
+        duration = self.breaker.open(duration)
         self.logger.info('Suspended for %5.2f sec', duration)
 
     def unsuspend(self):
-        self.suspend_to = 0.0
-        self.suspend_flag = False
-        self.logger.debug('Unsuspended')
+        if self.breaker.state != CircuitBreaker.CLOSED:
+            self.breaker.close()
+            self.logger.debug('Unsuspended')
+
+    def probing(self):
+        return self.breaker.state == CircuitBreaker.HALF_OPEN and self.breaker.probe == get_ident()
 
-    # check if suspended and try to reset
+    # fast check of breakers, expired breaker starts recovery probe in background
     def is_suspended(self):
-        if time.time() < self.suspend_to:  # if suspension does not expire
-            return True
-        # suspension expires
-        if self.suspend_flag:  # if it was suspended and expires
-            self.suspend_flag = False
-            self.reset()
-            if self.suspend_flag:  # was suspended during reset()
-                return True
-            else:
+        ident = get_ident()
+        if self.breaker.allow(ident):
+            if self.com.breaker.allow(ident):
                 return False
-        else:  # it was not suspended
-            return False
-
-    def _read(self, size=1, timeout=None):
-        result = b''
-        t0 = time.perf_counter()
-        while len(result) < size:
-            r = self.com.read(1)
-            if len(r) > 0:
-                result += r
-            else:
-                if timeout is not None and time.perf_counter() - t0 > timeout:
-                    self.logger.info('Reading timeout')
-                    raise SerialTimeoutException('Reading timeout')
-        return result
+            # port is down, recovered by probe of the device
+            self.suspend(self.com.breaker.remaining())
+            return True
+        if self.breaker.start_probe():
+            Thread(target=self.probe, name='Probe %s:%d' % (self.port, self.addr), daemon=True).start()
+        return True
 
-    def read(self, size=1):
+    def probe(self):
+        self.breaker.probe = get_ident()
         try:
-            result = self._read(size, self.read_timeout)
-            return result
-        except SerialTimeoutException:
-            self.logger.info('Reading timeout')
-            return b''
+            self.reset()
         except:
-            self.logger.info('Unexpected exception %s', sys.exc_info()[0])
-            self.logger.debug('Exception', exc_info=True)
-            return b''
-
-    def read_until(self, terminator=b'\r', size=None):
-        result = b''
-        t0 = time.perf_counter()
-        while terminator not in result:
-            r = self.read(1)
-            if len(r) <= 0:
-                self.suspend()
-                return result
-            result += r
-            if size is not None and len(result) >= size:
-                break
-            if time.perf_counter() - t0 > self.read_timeout:
+            self.logger.debug('Recovery probe error', exc_info=True)
+        # probe finished without verdict
+        if self.breaker.state == CircuitBreaker.HALF_OPEN:
+            if self.initialized():
+                self.unsuspend()
+            else:
                 self.suspend()
-                break
-        self.logger.debug('%s %s bytes in %4.0f ms', result, len(result), ms(t0))
-        return result
 
-    def read_response(self):
-        result = self.read_until(CR)
-        self.response = result
-        if CR not in result:
-            self.logger.error('Response %s without CR', self.response)
-            return False
-        # if checksum used
-        if not self.check:
-            return True
-        # checksum calculation
-        m = result.find(b'$')
-        if m < 0:
-            self.logger.error('No expected checksum in response')
-            return False
-        else:
-            cs = self.checksum(result[:m])
-            if result[m + 1:] != cs:
-                self.logger.error('Incorrect checksum')
-                return False
-            self.response = result[:m]
-            return True
+    def breakers(self):
+        return {'device': self.breaker.info(), 'port': self.com.breaker.info()}
 
     def check_response(self, expected=b'OK', response=None):
         if response is None:
@@ -499,139 +993,190 @@ class TDKLambda:
             return False
         return True
 
-    def write(self, cmd):
-        length = 0
-        result = False
-        t0 = time.perf_counter()
+    def prepare_command(self, cmd):
+        # unify command
+        cmd = cmd.upper().strip()
+        # convert str to bytes
+        if isinstance(cmd, str):
+            cmd = str.encode(cmd)
+        if not cmd.endswith(b'\r'):
+            cmd += b'\r'
+        # add checksum
+        if self.check:
+            cs = self.checksum(cmd[:-1])
+            cmd = b'%s$%s\r' % (cmd[:-1], cs)
+        return cmd
+
+    def send_command(self, cmd):
+        # blocking execution of command by the reactor thread
+        if self.is_suspended():
+            self.command = cmd
+            self.response = b''
+            self.logger.debug('Command %s to suspended device ignored', cmd)
+            return False
         try:
-            # reset input buffer
-            if not self.com.reset_input_buffer():
-                return False
-            # write command
-            length = self.com.write(cmd)
-            if len(cmd) == length:
-                result = True
-            else:
-                result = False
-            dt = (time.perf_counter() - t0) * 1000.0
-            self.logger.debug('%s %s bytes in %4.0f ms %s', cmd, length, dt, result)
-            return result
-        except SerialTimeoutException:
-            self.logger.error('Writing timeout')
-            dt = (time.perf_counter() - t0) * 1000.0
-            self.logger.debug('%s %s bytes in %4.0f ms %s', cmd, length, dt, result)
+            cmd = self.prepare_command(cmd)
+            if self.execute(cmd):
+                return True
+            self.logger.warning('Command %s error, repeat' % cmd)
+            if self.execute(cmd):
+                return True
+            self.logger.error('Repeated command %s error' % cmd)
+            self.state.clear()
+            self.suspend()
+            self.response = b''
             return False
         except:
             self.logger.error('Unexpected exception %s', sys.exc_info()[0])
-            dt = (time.perf_counter() - t0) * 1000.0
-            self.logger.debug('%s %s bytes in %4.0f ms %s', cmd, length, dt, result)
             self.logger.debug("", exc_info=True)
+            self.state.clear()
+            self.suspend()
+            self.response = b''
             return False
 
-    def _send_command(self, cmd):
-        self.command = cmd
-        self.response = b''
+    def execute(self, cmd):
         t0 = time.perf_counter()
-        # write command
-        if not self.write(cmd):
-            self.logger.debug('Error during write')
-            return False
-        # read response (to CR by default)
-        result = self.read_response()
-        dt = time.perf_counter() - t0
-        if result and dt < self.min_read_time:
-            self.min_read_time = dt
+        self.command = cmd
+        try:
+            response = self.submit(cmd).result(self.result_timeout())
+        except FutureTimeoutError:
+            self.logger.error('Command %s is not completed in time', cmd)
+            response = b''
+        result = len(response) > 0
+        if result and not self.check:
+            response += CR
+        self.response = response
         self.logger.debug('%s -> %s %s %4.0f ms', cmd, self.response, result, ms(t0))
         return result
 
-    def send_command(self, cmd):
-        with self.com.lock:
-            if self.is_suspended():
-                self.command = cmd
-                self.response = b''
-                self.logger.debug('Command %s to suspended device ignored', cmd)
-                return False
-            try:
-                # unify command
-                cmd = cmd.upper().strip()
-                # convert str to bytes
-                if isinstance(cmd, str):
-                    cmd = str.encode(cmd)
-                if not cmd.endswith(b'\r'):
-                    cmd += b'\r'
-                # add checksum
-                if self.check:
-                    cs = self.checksum(cmd[:-1])
-                    cmd = b'%s$%s\r' % (cmd[:-1], cs)
-                if self.auto_addr and self.com.current_addr != self.addr:
-                    result = self._set_addr()
-                    if not result:
-                        self.suspend()
-                        self.response = b''
-                        return False
-                result = self._send_command(cmd)
-                if result:
-                    return True
-                self.logger.warning('Command %s error, repeat' % cmd)
-                result = self._send_command(cmd)
-                if result:
-                    return True
-                self.logger.error('Repeated command %s error' % cmd)
-                self.suspend()
-                self.response = b''
-                return False
-            except:
-                self.logger.error('Unexpected exception %s', sys.exc_info()[0])
-                self.logger.debug("", exc_info=True)
-                self.suspend()
-                self.response = b''
-                return False
-
     def _set_addr(self):
         a0 = self.com.current_addr
-        result = self._send_command(b'ADR %d' % self.addr)
-        if result and self.check_response(b'OK'):
-            self.com.current_addr = self.addr
+        adr = self.prepare_command(b'ADR %d' % self.addr)
+        self.command = adr
+        # executed by the reactor in the port queue, other devices of the port wait for one deadline
+        tr = ComReactor.get().submit(self.com, Transaction(adr, self.addr, adr, self.adr_timeout()))
+        try:
+            frame = tr.future.result(self.result_timeout())
+        except:
+            self.logger.debug('ADR error', exc_info=True)
+            frame = b''
+        end = GenesisCodec.payload_end(frame, self.check)
+        self.response = frame[:end] if end >= 0 else b''
+        if self.response.startswith(b'OK'):
+            self.latency.record(adr, tr.elapsed)
             self.logger.debug('Address %d -> %d' % (a0, self.addr))
             return True
         else:
+            self.latency.missed(adr)
             self.logger.error('Error set address %d -> %d' % (a0, self.addr))
-            self.com.current_addr = -1
             return False
 
+    def result_timeout(self):
+        # the reactor completes transaction by its deadlines, waiting is bounded in case it fails,
+        # transactions queued before it may time out too
+        return (len(self.com.queue) + 2) * (2.0 * self.latency.max_timeout + ComReactor.MAX_LATE_GUARD)
+
+    def adr_timeout(self):
+        # ADR deadline, device which has never responded or is probed does not hold the port
+        # longer than other devices of the port need
+        adr = b'ADR %d' % self.addr
+        own = self.latency.learned_timeout(adr)
+        if own is not None and not self.probing():
+            return own
+        learned = [d.latency.learned_timeout(adr) for d in TDKLambda.devices if d.port == self.port and d is not self]
+        learned = [t for t in learned if t is not None]
+        if learned:
+            t = max(learned)
+        elif self.probing():
+            t = self.PROBE_TIMEOUT
+        else:
+            t = self.latency.max_timeout
+        return t if own is None else min(own, t)
+
     def read_float(self, cmd):
-        try:
-            if not self.send_command(cmd):
-                return float('Nan')
-            v = float(self.response)
-        except:
-            self.logger.debug('%s is not a float' % self.response)
-            v = float('Nan')
+        if not self.send_command(cmd):
+            return float('Nan')
+        code, v = GenesisCodec.decode_float(self.response)
+        if code < 0:
+            self.logger.debug('%s is not a float', self.response)
         return v
 
     def read_all(self):
+        # values are decoded into preallocated array
         if not self.send_command(b'DVC?'):
-            return [float('Nan')] * 6
-        reply = self.response
-        sv = reply.split(b',')
-        vals = []
-        for s in sv:
-            try:
-                v = float(s)
-            except:
-                self.logger.debug('%s is not a float', reply)
-                v = float('Nan')
-            vals.append(v)
-        if len(vals) <= 6:
-            vals = [*vals, *[float('Nan')] * 6]
-        return vals[:6]
+            code = GenesisCodec.decode_floats(b'', self.values)
+        else:
+            code = GenesisCodec.decode_floats(self.response, self.values)
+            if code < 0:
+                self.logger.debug('%s %s', GenesisCodec.MESSAGES[code], self.response)
+            self.confirm(b'PV', self.values[1])
+            self.confirm(b'PC', self.values[3])
+        return self.values
+
+    def read_status(self):
+        # STT? decoded into preallocated array, SR and FR registers are -1 on error
+        if not self.send_command(b'STT?'):
+            code = GenesisCodec.decode_status(b'', self.status)
+        else:
+            code = GenesisCodec.decode_status(self.response, self.status)
+            if code < 0:
+                self.logger.debug('%s %s', GenesisCodec.MESSAGES[code], self.response)
+            self.confirm(b'PV', self.status[1])
+            self.confirm(b'PC', self.status[3])
+            # CV/CC bits of SR do not show the OUT setting, it is confirmed only by OUT? and OK replies
+        return self.status
+
+    def status_flags(self):
+        # names of status and fault bits from the last STT?
+        return GenesisCodec.flags(self.status[4], self.status[5])
+
+    def output_on(self):
+        # output state from the last STT?, None if unknown
+        if self.status[4] < 0:
+            return None
+        return (int(self.status[4]) & 3) != 0
+
+    def enable_srq(self, fault_mask=0xFE, status_mask=0x08):
+        # program fault and status enable registers, device sends service request '!nn'
+        # on enabled events, so fault polling can be rare
+        self.srq = self.write_value(b'FENA', '%02X' % fault_mask) and \
+                   self.write_value(b'SENA', '%02X' % status_mask)
+        return self.srq
+
+    def srq_received(self):
+        # True if service request of the device was received since the last check
+        srq = self.com.check_srq()
+        if self.addr in srq:
+            srq.discard(self.addr)
+            return True
+        return False
+
+    def read_events(self):
+        # read and clear fault and status event registers, (-1, -1) on error
+        result = []
+        for cmd in (b'FEVE?', b'SEVE?'):
+            v = -1
+            if self.send_command(cmd):
+                try:
+                    v = int(self.response.strip(), 16)
+                except:
+                    pass
+            result.append(v)
+        return tuple(result)
 
     def read_value(self, cmd, v_type=type(str)):
         try:
-            if self.send_command(cmd):
-                v = v_type(self.response)
-            else:
+            if not self.send_command(cmd):
                 v = None
+            elif v_type is float:
+                code, v = GenesisCodec.decode_float(self.response)
+                if code < 0:
+                    self.logger.info('Can not convert %s to %s', self.response, v_type)
+                    v = None
+                if self.command[:3] in (b'PV?', b'PC?'):
+                    self.confirm(self.command[:2], v)
+            else:
+                v = v_type(self.response)
         except:
             self.logger.info('Can not convert %s to %s', self.response, v_type)
             v = None
@@ -648,20 +1193,81 @@ class TDKLambda:
         self.check_response(response=b'Not boolean:' + response)
         return False
 
-    def write_value(self, cmd, value, expect=b'OK'):
-        cmd = cmd.upper().strip() + b' ' + str.encode(str(value))[:10] + b'\r'
-        if self.send_command(cmd):
-            return self.check_response(expect)
+    @staticmethod
+    def state_value(key, value):
+        # programmed value as stored in state cache, None if it can not be cached
+        try:
+            if key == b'OUT':
+                if isinstance(value, (bytes, str)):
+                    value = value.encode() if isinstance(value, str) else value
+                    return value.strip().upper() in (b'ON', b'1')
+                return bool(value)
+            if isinstance(value, bytes):
+                return float(value)
+            return float(str(value)[:10])
+        except:
+            return None
+
+    def confirm(self, key, value):
+        # programmed value read back from device
+        if value is None or value != value:
+            self.state.pop(key, None)
         else:
+            self.state[key] = value
+
+    def cached(self, key, value):
+        # True if the value is programmed already, cached value is trusted while the device
+        # keeps responding
+        if key not in self.STATE_KEYS:
             return False
+        v = self.state_value(key, value)
+        return v is not None and self.state.get(key) == v and \
+            time.time() - self.com.seen.get(self.addr, 0.0) < self.LIVENESS_TIME
+
+    def write_value(self, cmd, value, expect=b'OK', force=False):
+        key = cmd.upper().strip()
+        if not force and self.cached(key, value):
+            self.write_stats['skipped'] += 1
+            return True
+        cmd = key + b' ' + str.encode(str(value))[:10] + b'\r'
+        if self.send_command(cmd) and self.check_response(expect):
+            # state is confirmed by engine
+            self.write_stats['written'] += 1
+            return True
+        return False
+
+    def submit_value(self, cmd, value, expect=b'OK', force=False):
+        # Non-blocking write_value without repetition, returns Future with True if the value is set.
+        # Queued setting of the same parameter is replaced by the newer one in the reactor,
+        # so only the latest value of a burst is written.
+        key = cmd.upper().strip()
+        future = Future()
+        if not force and self.cached(key, value):
+            self.write_stats['skipped'] += 1
+            future.set_result(True)
+            return future
+
+        def done(f):
+            try:
+                result = f.result().startswith(expect)
+            except:
+                result = False
+            if result:
+                self.write_stats['written'] += 1
+            future.set_result(result)
+
+        self.submit(key + b' ' + str.encode(str(value))[:10]).add_done_callback(done)
+        return future
 
     def read_output(self):
         if not self.send_command(b'OUT?'):
             return None
         response = self.response.upper()
         if response.startswith((b'ON', b'1')):
+            self.confirm(b'OUT', True)
             return True
         if response.startswith((b'OFF', b'0')):
+            self.confirm(b'OUT', False)
             return False
         self.logger.info('Unexpected response %s' % response)
         return None
@@ -692,40 +1298,55 @@ class TDKLambda:
         return self.read_value(b'PV?', v_type=float)
 
     def reset(self):
+        # recovery probe, executed in background thread while device breaker is half-open
         self.logger.debug('Resetting')
-        # if port was not initialized
-        if not self.com.ready:
-            self.com.close()
-            self.com.init()
-            if self.com.ready:
-                self.init()
-            else:
-                # suspend all devices on same port
-                for d in TDKLambda.devices:
-                    if d.port == self.port:
-                        d.suspend()
-            return
-        # port is OK, find working devices on same port
-        for d in TDKLambda.devices:
-            if d != self and d.port == self.port and d.alive():
+        if self.com.ready and self.com.breaker.state == CircuitBreaker.CLOSED:
+            # port is OK if other devices have responded recently
+            if self.com.alive(self.LIVENESS_TIME, self.addr):
                 self.init()
                 return
+            # liveness data is stale, active probes starting from the last responded device
+            others = [d for d in TDKLambda.devices if d != self and d.port == self.port]
+            others.sort(key=lambda d: self.com.seen.get(d.addr, 0.0), reverse=True)
+            for d in others:
+                if d.alive():
+                    self.init()
+                    return
         # no working devices on same port so try to recreate com port
-        self.com.close()
-        self.com.init()
-        if self.com.ready:
+        if self.reopen_port():
             self.init()
         else:
+            self.suspend()
+
+    def reopen_port(self):
+        breaker = self.com.breaker
+        t0 = time.time()
+        with self.com.reopen_lock:
+            # port has been reopened by probe of other device meanwhile
+            if self.com.ready and self.com.time >= t0:
+                return True
+            if breaker.state == CircuitBreaker.OPEN and not breaker.expired():
+                return False
+            breaker.start_probe()
+            self.com.close()
+            self.com.init()
+            if self.com.ready:
+                breaker.close()
+                return True
+            duration = breaker.open()
+            self.logger.info('Port reopening failed, next attempt in %5.2f sec', duration)
             # suspend all devices on same port
             for d in TDKLambda.devices:
-                if d.port == self.port:
-                    d.suspend()
-        return
+                if d.port == self.port and d != self:
+                    d.suspend(duration)
+            return False
 
     def initialized(self):
         return self.com.ready and self.id.find('LAMBDA') > 0
 
     def alive(self):
+        if time.time() - self.com.seen.get(self.addr, 0.0) < self.LIVENESS_TIME:
+            return True
         return self.read_serial_number() > 0
 
 
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 """TDK Lambda Genesis series power supply tango device server"""
 
+from array import array
 from threading import Lock
 from math import isnan
 
@@ -11,6 +12,8 @@ from tango import DevState
 from tango.server import Device, attribute, command
 
 from TDKLambda import TDKLambda
+from CircuitBreaker import CircuitBreaker
+from Poller import Poller
 from Utils import *
 
 ORGANIZATION_NAME = 'BINP'
@@ -18,15 +21,69 @@ APPLICATION_NAME = 'TDKLambda_Server'
 APPLICATION_NAME_SHORT = 'TDKLambda_Server'
 APPLICATION_VERSION = '2_9'  # asyncio from ver. 3
 
-# init a thread lock
+# device list lock, bus and device locks are used for device access
 _lock = Lock()
 # config logger
 logger = config_logger(level=logging.DEBUG)
+# events are pushed from poller threads
+if hasattr(tango, 'EnsureOmniThread'):
+    Poller.THREAD_CONTEXT = tango.EnsureOmniThread
+
+
+class Deadband:
+    # Value passes if it differs from the last passed one by abs_change or by rel_change
+    # fraction of its magnitude, any change passes if both are 0, or if the last value is 0
+    # for rel_change. Quality change always passes, and any value passes if period expires
+    # after the last one.
+    def __init__(self, abs_change=0.0, rel_change=0.0, period=0.0):
+        self.abs_change = abs_change
+        self.rel_change = rel_change
+        self.period = period
+        self.value = None
+        self.quality = None
+        self.time = 0.0
+
+    def passed(self, value, quality, t):
+        if self.value is None or quality != self.quality or 0.0 < self.period <= t - self.time:
+            changed = True
+        elif isinstance(value, bool):
+            changed = value != self.value
+        elif isnan(value) or isnan(self.value):
+            changed = isnan(value) != isnan(self.value)
+        else:
+            d = abs(value - self.value)
+            if self.abs_change <= 0.0 and self.rel_change <= 0.0:
+                changed = d > 0.0
+            else:
+                changed = (0.0 < self.abs_change <= d) or \
+                          (0.0 < self.rel_change and 0.0 < d and d >= self.rel_change * abs(self.value))
+        if changed:
+            self.value = value
+            self.quality = quality
+            self.time = t
+        return changed
 
 
 class TDKLambda_Server(Device):
     READING_VALID_TIME = 1.0
+    # cached values older than STALE_POLLS poll periods are invalid
+    STALE_POLLS = 3
+    # protection limits OVP and UVL are read by DVC? only if they are older
+    LIMITS_VALID_TIME = 10.0
+    # attributes decoded from STT?, index in values, change and archive events are pushed by poller
+    STATUS_ATTRIBUTES = {'voltage': 0, 'programmed_voltage': 1, 'current': 2, 'programmed_current': 3,
+                        'output_state': None}
+    # snapshot quality flags
+    SNAPSHOT_INVALID = 1
+    SNAPSHOT_STALE = 2
+    SNAPSHOT_OUTPUT_ON = 4
+    SNAPSHOT_FAULT = 8
+    SNAPSHOT_SUSPENDED = 16
+    # bus snapshot rows, numpy.frombuffer(data).reshape(-1, 11)
+    BUS_SNAPSHOT_FORMAT = 'float64 addr,mv,pv,mc,pc,ovp,uvl,sr,fr,time,flags'
     devices = []
+    # one lock per physical bus (ComPort), devices on different ports are served in parallel
+    bus_locks = {}
 
     port = attribute(label="Port", dtype=str,
                      display_level=DispLevel.OPERATOR,
@@ -46,6 +103,12 @@ class TDKLambda_Server(Device):
                             unit="", format="%s",
                             doc="TDKLambda device type")
 
+    breaker = attribute(label="Breaker", dtype=str,
+                        display_level=DispLevel.EXPERT,
+                        access=AttrWriteType.READ,
+                        unit="", format="%s",
+                        doc="Device and port circuit breaker states")
+
     output_state = attribute(label="Output", dtype=bool,
                              display_level=DispLevel.OPERATOR,
                              access=AttrWriteType.READ_WRITE,
@@ -80,6 +143,26 @@ class TDKLambda_Server(Device):
                                    min_value=0.0,
                                    doc="Programmed current")
 
+    poll_period = attribute(label="Poll Period", dtype=float,
+                            display_level=DispLevel.EXPERT,
+                            access=AttrWriteType.READ_WRITE,
+                            unit="s", format="%6.2f",
+                            min_value=0.0,
+                            doc="Background reading period, 0 - values are read by client requests")
+
+    snapshot = attribute(label="Snapshot", dtype=(float,), max_dim_x=10,
+                         display_level=DispLevel.OPERATOR,
+                         access=AttrWriteType.READ,
+                         unit="", format="%s",
+                         doc="DVC? values MV, PV, MC, PC, OVP, UVL, STT? registers SR, FR, time, quality flags "
+                             "(1 invalid, 2 stale, 4 output on, 8 fault bit of SR, 16 suspended)")
+
+    bus_snapshot = attribute(label="Bus Snapshot", dtype=tango.DevEncoded,
+                             display_level=DispLevel.OPERATOR,
+                             access=AttrWriteType.READ,
+                             doc="Snapshot rows of all supplies of the port, native float64 "
+                                 "addr, MV, PV, MC, PC, OVP, UVL, SR, FR, time, quality flags")
+
     def get_device_property(self, prop, default=None):
         name = self.get_name()
         if not hasattr(self, 'dp'):
@@ -103,9 +186,15 @@ class TDKLambda_Server(Device):
 
     def init_device(self):
         with _lock:
+            # bus lock for device io, short device lock for server side state
+            self.lock = Lock()
+            self.writes = []
             self.error_count = 0
-            self.values = [float('NaN')] * 6
+            # MV, PV, MC, PC, OVP, UVL, SR, FR
+            self.values = [float('NaN')] * 8
             self.time = time.time() - 100.0
+            self.limits_time = 0.0
+            self.poll_time = 0.0
             self.set_state(DevState.INIT)
             Device.init_device(self)
             self.last_level = logging.INFO
@@ -113,7 +202,17 @@ class TDKLambda_Server(Device):
             port = self.get_device_property('port', 'COM1')
             addr = self.get_device_property('addr', 6)
             # create TDKLambda device
-            self.tdk = TDKLambda(port, addr)
+            self.bus_lock = TDKLambda_Server.bus_locks.setdefault(port.strip(), Lock())
+            with self.bus_lock:
+                self.tdk = TDKLambda(port, addr)
+                # faults are reported by service requests if enabled
+                if self.get_device_property('srq', 0):
+                    self.tdk.enable_srq()
+            # values are read by port poller in background
+            self.period = self.get_device_property('poll_period', self.READING_VALID_TIME)
+            self.setup_events()
+            self.poller = Poller.get(self.tdk.port)
+            self.poller.add(self)
             # self.tdk.init()
             # check if device OK
             if self.tdk.initialized():
@@ -132,6 +231,7 @@ class TDKLambda_Server(Device):
 
     def delete_device(self):
         with _lock:
+            self.poller.remove(self)
             if self in TDKLambda_Server.devices:
                 TDKLambda_Server.devices.remove(self)
                 self.tdk.__del__()
@@ -149,17 +249,28 @@ class TDKLambda_Server(Device):
             return str(self.tdk.addr)
         return "-1"
 
+    def read_breaker(self):
+        return 'device %s, port %s' % (self.tdk.breaker.state, self.tdk.com.breaker.state)
+
     def read_device_type(self):
-        with _lock:
+        with self.lock:
             if self.tdk.initialized():
                 return self.tdk.id
             return "Uninitialized"
 
+    @staticmethod
+    def output_on(values):
+        # output state from SR of the server copy of values, None if unknown
+        if not values[6] >= 0:
+            return None
+        return (int(values[6]) & 3) != 0
+
     def read_output_state(self):
-        with _lock:
+        # output state is decoded from the last STT?
+        with self.lock:
             if self.tdk.initialized():
-                value = self.tdk.read_output()
-                if value is not None:
+                value = self.output_on(self.values)
+                if value is not None and not self.values_stale():
                     qual = AttrQuality.ATTR_VALID
                     self.set_running()
                 else:
@@ -177,7 +288,7 @@ class TDKLambda_Server(Device):
             return value
 
     def write_output_state(self, value):
-        with _lock:
+        with self.bus_lock:
             if self.tdk.com is None:
                 msg = '%s:%d Switch output for offline device' % (self.tdk.port, self.tdk.addr)
                 self.debug_stream(msg)
@@ -189,6 +300,7 @@ class TDKLambda_Server(Device):
                 if self.tdk.write_output(value):
                     self.output_state.set_quality(AttrQuality.ATTR_VALID)
                     result = True
+                    self.invalidate_values()
                     self.set_running()
                 else:
                     msg = '%s:%d Error switch output' % (self.tdk.port, self.tdk.addr)
@@ -202,9 +314,18 @@ class TDKLambda_Server(Device):
     def read_all(self):
         t0 = time.time()
         try:
-            values = self.tdk.read_all()
-            self.values = values
-            self.time = time.time()
+            # STT? gives measured and programmed values with status and fault registers
+            values = self.tdk.read_status()
+            limits = self.values[4:6]
+            if values[4] >= 0 and time.time() - self.limits_time > self.LIMITS_VALID_TIME:
+                # protection limits are changed rarely, DVC? is not read every poll
+                limits = list(self.tdk.read_all()[4:6])
+                if not any(isnan(v) for v in limits):
+                    self.limits_time = time.time()
+            with self.lock:
+                # decoded in place by the next reading, copy is kept
+                self.values = [*values[:4], *limits, values[4], values[5]]
+                self.time = time.time()
             msg = '%s:%d read_all %s ms %s' % \
                   (self.tdk.port, self.tdk.addr, int((self.time - t0) * 1000.0), values)
             logger.debug(msg)
@@ -216,13 +337,148 @@ class TDKLambda_Server(Device):
             logger.debug('', exc_info=True)
             self.info_stream(msg)
 
-    def read_voltage(self, attr):
-        with _lock:
-            if time.time() - self.time > self.READING_VALID_TIME:
+    def read_attr_hardware(self, attr_list):
+        # one STT? per device for all attributes of the request, read methods only fill values
+        self.check_writes()
+        attrs = self.get_device_attr()
+        names = set(attrs.get_attr_by_ind(i).get_name() for i in attr_list)
+        if 'bus_snapshot' in names:
+            for d in self.bus_devices():
+                d.update_values()
+        elif 'snapshot' in names or not names.isdisjoint(self.STATUS_ATTRIBUTES):
+            self.update_values()
+
+    def bus_devices(self):
+        devices = [d for d in TDKLambda_Server.devices if d.tdk.port == self.tdk.port]
+        if self not in devices:
+            devices.append(self)
+        devices.sort(key=lambda d: d.tdk.addr)
+        return devices
+
+    def snapshot_row(self):
+        with self.lock:
+            row = [*self.values, self.time]
+        flags = 0
+        if any(isnan(v) for v in row[:4]):
+            flags |= self.SNAPSHOT_INVALID
+        if self.values_stale():
+            flags |= self.SNAPSHOT_STALE
+        if self.output_on(row):
+            flags |= self.SNAPSHOT_OUTPUT_ON
+        # SR is -1 if STT? failed
+        if row[6] >= 0 and int(row[6]) & 0x08:
+            flags |= self.SNAPSHOT_FAULT
+        if self.tdk.breaker.state != CircuitBreaker.CLOSED:
+            flags |= self.SNAPSHOT_SUSPENDED
+        row.append(float(flags))
+        return row
+
+    def read_snapshot(self):
+        return self.snapshot_row()
+
+    def read_bus_snapshot(self):
+        data = array('d')
+        for d in self.bus_devices():
+            data.append(d.tdk.addr)
+            data.extend(d.snapshot_row())
+        return self.BUS_SNAPSHOT_FORMAT, data.tobytes()
+
+    def update_values(self):
+        # values are refreshed by poller, client reads only if polling is disabled
+        if self.period > 0.0:
+            return
+        # bus lock is held during reading, attribute readers of other devices of the bus wait
+        with self.bus_lock:
+            if self.values_expired():
                 self.read_all()
+
+    def invalidate_values(self):
+        # cached status is not valid, poller reads it at once
+        self.time = 0.0
+        self.poll_time = 0.0
+        self.poller.wake()
+
+    def poll_due(self, now):
+        if self.period <= 0.0:
+            return None
+        if self.tdk.srq and self.tdk.addr in self.tdk.com.check_srq():
+            return 0.0
+        return self.poll_time + self.period - now
+
+    def poll(self):
+        self.poll_time = time.time()
+        with self.bus_lock:
+            self.service_request()
+            self.read_all()
+        self.check_writes()
+        self.push_events()
+
+    def values_stale(self):
+        return self.period > 0.0 and time.time() - self.time > self.STALE_POLLS * self.period
+
+    def service_request(self):
+        # service request of the device makes cached values invalid
+        if self.tdk.srq and self.tdk.srq_received():
+            msg = '%s:%d service request, fault and status events %s' % \
+                  (self.tdk.port, self.tdk.addr, self.tdk.read_events())
+            logger.info(msg)
+            self.info_stream(msg)
+            return True
+        return False
+
+    def values_expired(self):
+        if self.service_request():
+            return True
+        return time.time() - self.time > self.READING_VALID_TIME
+
+    def setup_events(self):
+        # deadbands from properties like 'voltage_abs_change', 'voltage_archive_rel_change',
+        # relative ones are in percent as Tango rel_change, archive events are also sent
+        # every 'archive_period' seconds if it is not 0
+        archive_period = self.get_device_property('archive_period', 0.0)
+        self.change_filters = {}
+        self.archive_filters = {}
+        for name in self.STATUS_ATTRIBUTES:
+            self.set_change_event(name, True, False)
+            self.set_archive_event(name, True, False)
+            self.change_filters[name] = Deadband(self.get_device_property(name + '_abs_change', 0.0),
+                                                 self.get_device_property(name + '_rel_change', 0.0) / 100.0)
+            self.archive_filters[name] = Deadband(self.get_device_property(name + '_archive_abs_change', 0.0),
+                                                  self.get_device_property(name + '_archive_rel_change', 0.0) / 100.0,
+                                                  archive_period)
+
+    def push_events(self):
+        with self.lock:
+            values = self.values
+            t = self.time
+        for name, index in self.STATUS_ATTRIBUTES.items():
+            if index is None:
+                value = self.output_on(values)
+                quality = AttrQuality.ATTR_INVALID if value is None else AttrQuality.ATTR_VALID
+                value = bool(value)
+            else:
+                value = float(values[index])
+                quality = AttrQuality.ATTR_INVALID if isnan(value) else AttrQuality.ATTR_VALID
+            if self.change_filters[name].passed(value, quality, t):
+                self.push_change_event(name, value, t, quality)
+            if self.archive_filters[name].passed(value, quality, t):
+                self.push_archive_event(name, value, t, quality)
+
+    def read_poll_period(self):
+        return self.period
+
+    def write_poll_period(self, value):
+        with self.lock:
+            self.period = max(float(value), 0.0)
+            msg = '%s:%d poll period %s s' % (self.tdk.port, self.tdk.addr, self.period)
+            logger.info(msg)
+        self.poller.wake()
+
+    def read_voltage(self, attr):
+        with self.lock:
             val = self.values[0]
             attr.set_value(val)
-            if isnan(val):
+            if isnan(val) or self.values_stale():
                 attr.set_quality(AttrQuality.ATTR_INVALID)
                 msg = "%s Output voltage read error" % self
                 self.info_stream(msg)
@@ -234,12 +490,10 @@ class TDKLambda_Server(Device):
             return val
 
     def read_current(self, attr):
-        with _lock:
-            if time.time() - self.time > self.READING_VALID_TIME:
-                self.read_all()
+        with self.lock:
             val = self.values[2]
             attr.set_value(val)
-            if isnan(val):
+            if isnan(val) or self.values_stale():
                 attr.set_quality(AttrQuality.ATTR_INVALID)
                 msg = "%s Output current read error" % self
                 self.info_stream(msg)
@@ -251,12 +505,10 @@ class TDKLambda_Server(Device):
             return val
 
     def read_programmed_voltage(self, attr):
-        with _lock:
-            if time.time() - self.time > self.READING_VALID_TIME:
-                self.read_all()
+        with self.lock:
             val = self.values[1]
             attr.set_value(val)
-            if isnan(val):
+            if isnan(val) or self.values_stale():
                 attr.set_quality(AttrQuality.ATTR_INVALID)
                 msg = "%s Programmed voltage read error" % self
                 self.info_stream(msg)
@@ -268,12 +520,10 @@ class TDKLambda_Server(Device):
             return val
 
     def read_programmed_current(self, attr):
-        with _lock:
-            if time.time() - self.time > self.READING_VALID_TIME:
-                self.read_all()
+        with self.lock:
             val = self.values[3]
             attr.set_value(val)
-            if isnan(val):
+            if isnan(val) or self.values_stale():
                 attr.set_quality(AttrQuality.ATTR_INVALID)
                 msg = "%s Programmed current  read error" % self
                 self.info_stream(msg)
@@ -285,48 +535,42 @@ class TDKLambda_Server(Device):
             return val
 
     def write_programmed_voltage(self, value):
-        with _lock:
-            if self.tdk.com is None:
-                self.programmed_voltage.set_quality(AttrQuality.ATTR_INVALID)
-                msg = "%s Writing to offline device" % self
-                self.info_stream(msg)
-                logger.warning(msg)
-                result = False
-                self.set_fault()
-            else:
-                result = self.tdk.write_value(b'PV', value)
-            if result:
-                self.programmed_voltage.set_quality(AttrQuality.ATTR_VALID)
-                self.set_running()
-            else:
-                self.programmed_voltage.set_quality(AttrQuality.ATTR_INVALID)
-                msg = "%s Error writing programmed voltage" % self
-                self.info_stream(msg)
-                logger.warning(msg)
-                self.set_fault()
-            return result
+        return self.write_setting(self.programmed_voltage, b'PV', value, 'Error writing programmed voltage')
 
     def write_programmed_current(self, value):
-        with _lock:
-            if self.tdk.com is None:
-                self.programmed_current.set_quality(AttrQuality.ATTR_INVALID)
-                msg = "%s Writing to offline device" % self
-                self.info_stream(msg)
-                logger.warning(msg)
-                result = False
-                self.set_fault()
-            else:
-                result = self.tdk.write_value(b'PC', value)
-            if result:
-                self.programmed_current.set_quality(AttrQuality.ATTR_VALID)
+        return self.write_setting(self.programmed_current, b'PC', value, 'Error writing programmed current')
+
+    def write_setting(self, attr, cmd, value, message):
+        # setting is queued without waiting for the bus, so the reactor replaces queued value
+        # of a slider burst by the newer one, result is checked by check_writes
+        self.check_writes()
+        if self.tdk.com is None:
+            attr.set_quality(AttrQuality.ATTR_INVALID)
+            msg = "%s Writing to offline device" % self
+            self.info_stream(msg)
+            logger.warning(msg)
+            self.set_fault()
+            return False
+        future = self.tdk.submit_value(cmd, value)
+        with self.lock:
+            self.writes.append((future, attr, message))
+        return True
+
+    def check_writes(self):
+        # results of completed queued settings
+        with self.lock:
+            done = [w for w in self.writes if w[0].done()]
+            self.writes = [w for w in self.writes if not w[0].done()]
+        for future, attr, message in done:
+            if future.result():
+                attr.set_quality(AttrQuality.ATTR_VALID)
                 self.set_running()
             else:
-                self.programmed_current.set_quality(AttrQuality.ATTR_INVALID)
-                msg = "%s Error writing programmed current" % self
+                attr.set_quality(AttrQuality.ATTR_INVALID)
+                msg = "%s %s" % (self, message)
                 self.info_stream(msg)
                 logger.warning(msg)
                 self.set_fault()
-            return result
 
     def set_running(self):
         self.error_count = 0
@@ -339,15 +583,15 @@ class TDKLambda_Server(Device):
 
     @command
     def Reset(self):
-        with _lock:
+        with self.bus_lock:
             msg = '%s:%d Reset TDKLambda PS' % (self.tdk.port, self.tdk.addr)
             logger.info(msg)
             self.info_stream(msg)
-            self.tdk._send_command(b'RST')
+            self.tdk.send_command(b'RST')
 
     @command
     def Debug(self):
-        with _lock:
+        with self.lock:
             if self.tdk.logger.getEffectiveLevel() != logging.DEBUG:
                 self.last_level = self.tdk.logger.getEffectiveLevel()
                 logger.setLevel(logging.DEBUG)
@@ -363,7 +607,7 @@ class TDKLambda_Server(Device):
 
     @command(dtype_in=int)
     def SetLogLevel(self, level):
-        with _lock:
+        with self.lock:
             msg = '%s:%d set log level to %d' % (self.tdk.port, self.tdk.addr, level)
             logger.info(msg)
             self.info_stream(msg)
@@ -373,8 +617,8 @@ class TDKLambda_Server(Device):
     @command(dtype_in=str, doc_in='Directly send command to the device',
              dtype_out=str, doc_out='Response from device without final CR')
     def SendCommand(self, cmd):
-        with _lock:
-            rsp = self.tdk.send_command(cmd).decode()
+        with self.bus_lock:
+            rsp = self.tdk.submit(cmd).result(self.tdk.result_timeout()).decode()
             msg = '%s:%d %s -> %s' % (self.tdk.port, self.tdk.addr, cmd, rsp)
             logger.debug(msg)
             self.debug_stream(msg)
@@ -386,9 +630,13 @@ class TDKLambda_Server(Device):
                 return
             return rsp
 
+    @command(dtype_out=str, doc_out='Device and port breaker states and transition counts')
+    def BreakerInfo(self):
+        return str(self.tdk.breakers())
+
     @command
     def TurnOn(self):
-        with _lock:
+        with self.lock:
             # turn on the actual power supply here
             msg = '%s Turn On' % self
             logger.debug(msg)
@@ -397,7 +645,7 @@ class TDKLambda_Server(Device):
 
     @command
     def TurnOff(self):
-        with _lock:
+        with self.lock:
             # turn off the actual power supply here
             msg = '%s Turn Off' % self
             logger.debug(msg)